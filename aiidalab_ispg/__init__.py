@@ -1,13 +1,30 @@
-from aiidalab_ispg.structures import StructureSelectionStep
-from aiidalab_ispg.steps import (
-    SubmitOrcaAppWorkChainStep,
-)
+import importlib
 
 __all__ = [
     "StructureSelectionStep",
     "SubmitOrcaAppWorkChainStep",
 ]
 
+# Widgets are imported lazily on first access, so that importing
+# lightweight submodules such as aiidalab_ispg.spectrum_core
+# does not pull in ipywidgets, Bokeh and AiiDA ORM.
+_LAZY_IMPORTS = {
+    "StructureSelectionStep": "aiidalab_ispg.structures",
+    "SubmitOrcaAppWorkChainStep": "aiidalab_ispg.steps",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        module = importlib.import_module(_LAZY_IMPORTS[name])
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
 # WARNING: This needs to be kept in sync with version
 # in setup.cfg
 # TODO: Take a look and how aiidalab-qe and other packages do it.
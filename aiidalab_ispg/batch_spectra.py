@@ -0,0 +1,284 @@
+"""Compute broadened UV/Vis spectra for many finished AtmospecWorkChains.
+
+Usage:
+    aiidalab-ispg-spectra --group my_molecules -o spectra.npz
+    aiidalab-ispg-spectra 1234 1240 -o spectra.npz --kernel lorentzian
+
+Workchains given by PKs and by --group are combined.
+
+All spectra are stored in a single compressed NPZ file with arrays
+    pk: PKs of the workchains
+    smiles: SMILES of the input structures (empty string if unknown)
+    offsets: spectrum i is x[offsets[i]:offsets[i+1]], same for y
+    x: concatenated energies (in a given energy unit)
+    y: concatenated cross sections (cm^2 per molecule)
+and scalar metadata kernel, width (eV), energy_unit and temperature (K).
+Conformers are Boltzmann-weighted at a given temperature,
+unless the workchain did not store conformer energies.
+Use read_spectra() to get the spectra back keyed by PK.
+
+Authors:
+    * Daniel Hollas <daniel.hollas@durham.ac.uk>
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
+import numpy as np
+
+from aiidalab_ispg.spectrum_core import Spectrum, TransitionSet, boltzmann_weights
+from aiidalab_ispg.units import ENERGY_UNITS
+
+KERNELS = ("gaussian", "lorentzian")
+# Default temperature in Kelvins for Boltzmann weighting of conformers,
+# same as in SpectrumWidget
+TEMPERATURE = 298.15
+
+
+def load_spectrum_data(node):
+    """Returns the contents of the spectrum_data output of AtmospecWorkChain
+    as accepted by TransitionSet.from_spectrum_data(), i.e. a dictionary
+    of arrays from ArrayData, or a list of ORCA outputs from older workflows"""
+    from aiida.orm import List
+
+    if isinstance(node, List):
+        return node.get_list()
+    return {name: node.get_array(name) for name in node.get_arraynames()}
+
+
+def load_conformer_energies(node):
+    """Returns conformer energies in eV from the relaxed_structures output
+    of AtmospecWorkChain, or None for older workflows without them"""
+    if "energies" not in node.get_arraynames():
+        return None
+    return node.get_array("energies")
+
+
+def _get_group_members(group):
+    """PKs of all nodes in a group with a given label"""
+    from aiida.orm import Group, Node, QueryBuilder
+
+    qb = QueryBuilder()
+    qb.append(Group, filters={"label": group}, tag="group")
+    qb.append(Node, with_group="group", project=["id"])
+    return set(qb.all(flat=True))
+
+
+def _append_workchains(qb, pks=None):
+    """Append finished AtmospecWorkChains, optionally only those
+    with given PKs, to a query, tagged as 'wc'"""
+    from aiidalab_atmospec_workchain import AtmospecWorkChain
+
+    filters = {"attributes.exit_status": 0}
+    if pks:
+        filters["id"] = {"in": list(pks)}
+    qb.append(AtmospecWorkChain, filters=filters, project=["id"], tag="wc")
+
+
+def query_spectrum_data(pks=None, group=None):
+    """Yields (pk, smiles, spectrum_data, conformer_energies)
+    for finished AtmospecWorkChains given by PKs, by group label,
+    or both, in which case workchains from both are returned (their union).
+    Without PKs and group, all finished AtmospecWorkChains are returned.
+    conformer_energies is None if the workchain did not store them."""
+    from aiida.orm import Data, QueryBuilder, TrajectoryData
+
+    if group is not None:
+        pks = _get_group_members(group).union(pks or ())
+        if not pks:
+            return
+
+    # Conformer energies are stored in the optional relaxed_structures output,
+    # so they are fetched with a separate query.
+    qb = QueryBuilder()
+    _append_workchains(qb, pks)
+    qb.append(
+        TrajectoryData,
+        with_incoming="wc",
+        edge_filters={"label": "relaxed_structures"},
+        project=["*"],
+    )
+    conformer_energies = {
+        pk: load_conformer_energies(node) for pk, node in qb.iterall()
+    }
+
+    qb = QueryBuilder()
+    _append_workchains(qb, pks)
+    # The input structure is TrajectoryData for multiple conformers,
+    # which is the only case in which spectrum_data is returned.
+    qb.append(
+        Data,
+        with_outgoing="wc",
+        edge_filters={"label": "structure"},
+        project=["extras.smiles"],
+    )
+    # Spectrum data is either ArrayData, or List from older workflows
+    qb.append(
+        Data,
+        with_incoming="wc",
+        edge_filters={"label": "spectrum_data"},
+        project=["*"],
+    )
+    qb.order_by({"wc": {"id": "asc"}})
+    for pk, smiles, node in qb.iterall():
+        yield pk, smiles, load_spectrum_data(node), conformer_energies.get(pk)
+
+
+def compute_spectrum(
+    spectrum_data,
+    conformer_energies=None,
+    kernel="gaussian",
+    width=0.1,
+    energy_unit="nm",
+    temperature=TEMPERATURE,
+):
+    """Returns broadened spectrum (x, y) from the spectrum_data
+    output of AtmospecWorkChain. Conformers are weighted by their
+    Boltzmann populations if conformer_energies (in eV) are given,
+    the same as in SpectrumWidget."""
+    transitions = TransitionSet.from_spectrum_data(spectrum_data)
+    if len(transitions) == 0:
+        return np.empty(0), np.empty(0)
+    conformer_weights = None
+    nconformer = int(transitions.conformer_indices.max()) + 1
+    if conformer_energies is not None and len(conformer_energies) == nconformer:
+        conformer_weights = boltzmann_weights(conformer_energies, temperature)
+    spectrum = Spectrum(transitions, conformer_weights=conformer_weights)
+    if kernel == "gaussian":
+        x, y = spectrum.get_gaussian_spectrum(width, energy_unit, "")
+    else:
+        x, y = spectrum.get_lorentzian_spectrum(width, energy_unit, "")
+    return x, y
+
+
+def _compute_spectrum_worker(args):
+    pk, *args = args
+    x, y = compute_spectrum(*args)
+    return pk, x, y
+
+
+def compute_spectra(
+    records,
+    kernel="gaussian",
+    width=0.1,
+    energy_unit="nm",
+    temperature=TEMPERATURE,
+    max_workers=None,
+):
+    """Compute spectra for (pk, smiles, spectrum_data, conformer_energies)
+    records in a pool of worker processes.
+    Returns a dictionary with arrays as described in the module docstring."""
+    records = list(records)
+    smiles = {pk: s or "" for pk, s, _, _ in records}
+    tasks = [
+        (pk, data, energies, kernel, width, energy_unit, temperature)
+        for pk, _, data, energies in records
+    ]
+
+    if max_workers == 1:
+        results = list(map(_compute_spectrum_worker, tasks))
+    else:
+        max_workers = max_workers or os.cpu_count() or 1
+        # Bigger chunks amortize the cost of sending inputs to workers
+        chunksize = max(1, len(tasks) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(_compute_spectrum_worker, tasks, chunksize=chunksize)
+            )
+    pks = [pk for pk, _, _ in results]
+    xs = [x for _, x, _ in results]
+    ys = [y for _, _, y in results]
+
+    offsets = np.zeros(len(xs) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in xs], out=offsets[1:])
+    return {
+        "pk": np.array(pks, dtype=np.int64),
+        "smiles": np.array([smiles[pk] for pk in pks], dtype=str),
+        "offsets": offsets,
+        "x": np.concatenate(xs) if xs else np.empty(0),
+        "y": np.concatenate(ys) if ys else np.empty(0),
+        "kernel": np.array(kernel),
+        "width": np.array(width),
+        "energy_unit": np.array(energy_unit),
+        "temperature": np.array(temperature),
+    }
+
+
+def read_spectra(filename):
+    """Read spectra written by this script.
+    Returns a dictionary {pk: (smiles, x, y)}"""
+    with np.load(filename) as data:
+        offsets = data["offsets"]
+        x, y = data["x"], data["y"]
+        return {
+            int(pk): (str(smiles), x[start:end], y[start:end])
+            for pk, smiles, start, end in zip(
+                data["pk"], data["smiles"], offsets[:-1], offsets[1:]
+            )
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compute UV/Vis spectra from finished AtmospecWorkChains"
+    )
+    parser.add_argument("pks", nargs="*", type=int, help="AtmospecWorkChain PKs")
+    parser.add_argument(
+        "-g",
+        "--group",
+        help="Label of a group of workchains, added to the ones given by PKs",
+    )
+    parser.add_argument("-o", "--output", default="spectra.npz", help="NPZ file")
+    parser.add_argument("-k", "--kernel", choices=KERNELS, default="gaussian")
+    parser.add_argument(
+        "-w", "--width", type=float, default=0.1, help="Broadening width in eV"
+    )
+    parser.add_argument("-u", "--energy-unit", choices=ENERGY_UNITS, default="nm")
+    parser.add_argument(
+        "-T",
+        "--temperature",
+        type=float,
+        default=TEMPERATURE,
+        help="Temperature in K for Boltzmann weighting of conformers",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument("-p", "--profile", help="AiiDA profile")
+    args = parser.parse_args(argv)
+
+    if not args.pks and args.group is None:
+        parser.error("Specify workchain PKs and/or --group")
+    if args.width <= 0.0:
+        parser.error("Broadening width must be positive")
+    if args.temperature <= 0.0:
+        parser.error("Temperature must be positive")
+
+    from aiida import load_profile
+
+    load_profile(args.profile)
+
+    records = query_spectrum_data(pks=args.pks, group=args.group)
+    spectra = compute_spectra(
+        records,
+        kernel=args.kernel,
+        width=args.width,
+        energy_unit=args.energy_unit,
+        temperature=args.temperature,
+        max_workers=args.workers,
+    )
+    if len(spectra["pk"]) == 0:
+        print("ERROR: No finished AtmospecWorkChains found", file=sys.stderr)
+        return 1
+    np.savez_compressed(args.output, **spectra)
+    print(f"Wrote {len(spectra['pk'])} spectra to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,25 +3,72 @@
 Authors:
     * Daniel Hollas <daniel.hollas@durham.ac.uk>
 """
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Event, Lock, RLock, Thread, current_thread
+import time
+
 import ipywidgets as ipw
 import traitlets
-import scipy
-from scipy import constants
 import numpy as np
 
-from aiida.orm import QueryBuilder
+from aiida.common import NotExistent
+from aiida.orm import QueryBuilder, load_node
 from aiida.plugins import DataFactory
 
-# https://docs.bokeh.org/en/latest/docs/user_guide/jupyter.html
-# https://github.com/bokeh/bokeh/blob/branch-3.0/examples/howto/server_embed/notebook_embed.ipynb
-# https://github.com/bokeh/bokeh/blob/branch-3.0/examples/howto/server_embed/notebook_embed.ipynb
-from bokeh.io import push_notebook, show, output_notebook
-import bokeh.plotting as plt
+from aiidalab_ispg.units import convert_energy_unit
+
+# Numerical code lives in a separate module without widget dependencies,
+# re-exported here for backwards compatibility.
+from aiidalab_ispg.spectrum_core import (  # noqa: F401
+    Spectrum,
+    SpectrumAccumulator,
+    TransitionSet,
+    boltzmann_weights,
+    bootstrap_confidence_band,
+)
 
-# https://docs.bokeh.org/en/latest/docs/reference/io.html#bokeh.io.output_notebook
-output_notebook(hide_banner=True, load_timeout=5000, verbose=True)
 XyData = DataFactory("array.xy")
 
+_bokeh_notebook_initialized = False
+
+
+def _init_bokeh_notebook():
+    """Load BokehJS into the notebook. Bokeh is imported lazily
+    here, i.e. only when the first SpectrumWidget is created."""
+    global _bokeh_notebook_initialized
+    if _bokeh_notebook_initialized:
+        return
+    # https://docs.bokeh.org/en/latest/docs/user_guide/jupyter.html
+    # https://github.com/bokeh/bokeh/blob/branch-3.0/examples/howto/server_embed/notebook_embed.ipynb
+    from bokeh.io import output_notebook
+
+    # https://docs.bokeh.org/en/latest/docs/reference/io.html#bokeh.io.output_notebook
+    output_notebook(hide_banner=True, load_timeout=5000, verbose=True)
+    _bokeh_notebook_initialized = True
+
+
+class _LRUCache(OrderedDict):
+    """Simple dictionary that holds at most maxsize items,
+    evicting the least recently used ones"""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
 
 # This code was provided by a good soul on GitHub.
 # https://github.com/bokeh/bokeh/issues/7023#issuecomment-839825139
@@ -31,9 +78,16 @@ class BokehFigureContext(ipw.Output):
     def __init__(self, fig):
         super().__init__()
         self._figure = fig
+        self._hold_lock = Lock()
+        self._hold_count = 0
+        self._update_pending = False
+        # Set when the figure is displayed
+        self._handle = None
         self.on_displayed(lambda x: x.set_handle())
 
     def set_handle(self):
+        from bokeh.io import show
+
         self.clear_output()
         with self:
             self._handle = show(self._figure, notebook_handle=True)
@@ -45,175 +99,297 @@ class BokehFigureContext(ipw.Output):
         return self._figure
 
     def update(self):
-        push_notebook(handle=self._handle)
+        with self._hold_lock:
+            if self._hold_count > 0:
+                self._update_pending = True
+                return
+        if self._handle is None:
+            # Not displayed yet, current state is shown once it is
+            return
+        from bokeh.io import push_notebook
 
+        push_notebook(handle=self._handle)
 
-class Spectrum(object):
-    AUtoCm = 8.478354e-30
-    COEFF = (
-        constants.pi
-        * AUtoCm**2
-        * 1e4
-        / (3 * scipy.constants.hbar * scipy.constants.epsilon_0 * scipy.constants.c)
-    )
-    # Transition Dipole to Osc. Strength in atomic units
-    COEFF_NEW = COEFF * 3 / 2
-    # COEFF =  scipy.constants.pi * AUtoCm**2 * 1e4 * scipy.constants.hbar / (2 * scipy.constants.epsilon_0 * scipy.constants.c * scipy.constants.m_e)
-
-    def __init__(self, transitions, nsample):
-        # Excitation energies in eV
-        self.excitation_energies = np.array(
-            [tr["energy"] for tr in transitions], dtype=float
-        )
-        # Oscillator strengths
-        self.osc_strengths = np.array(
-            [tr["osc_strength"] for tr in transitions], dtype=float
-        )
-        # Number of molecular geometries sampled from ground state distribution
-        self.nsample = nsample
-
-    # TODO
-    def get_spectrum(self, x_min, x_max, x_units, y_units):
-        """Returns a non-broadened spectrum as a tuple of x and y Numpy arrays"""
-        n_points = int((x_max - x_min) / self.de)
-        x = np.arange(x_min, x_max, self.de)
-        y = np.zeros(n_points)
-        return x, y
-
-    # TODO: Make this function aware of units?
-    def _get_energy_range(self, energy_unit):
-        # NOTE: We don't include zero to prevent
-        # division by zero when converting to wavelength
-        x_min = max(0.01, self.excitation_energies.min() - 2.0)
-        x_max = self.excitation_energies.max() + 2.0
-
-        # conversion to nanometers is handled later
-        if energy_unit.lower() == "nm":
-            return x_min, x_max
-
-        # energy_factor_unit = self._get_energy_unit_factor(energy_unit)
-        # x_min *= energy_factor_unit
-        # x_max *= energy_factor_unit
-        return x_min, x_max
-
-    # TODO: Define energy units as Enum in this file.
-    # TODO: Put this function outside of this class
-    # So that it can be useful for experimental spectrum as well
-    def _get_energy_unit_factor(self, unit):
-
-        # https://physics.nist.gov/cgi-bin/cuu/Info/Constants/basis.html
-        # TODO: We should probably start from atomic units
-        if unit.lower() == "ev":
-            return 1.0
-        # TODO: Construct these factors from scipy.constants
-        elif unit.lower() == "nm":
-            return 1239.8
-        elif unit.lower() == "cm^-1":
-            # https://physics.nist.gov/cgi-bin/cuu/Convert?exp=0&num=1&From=ev&To=minv&Action=Only+show+factor
-            return 8065.547937
-
-    def get_gaussian_spectrum(self, sigma, x_unit, y_unit):
-        """Returns Gaussian broadened spectrum"""
-
-        x_min, x_max = self._get_energy_range(x_unit)
-
-        # Conversion factor from eV to given energy unit
-        # (should probably switch to atomic units as default)
-        energy_unit_factor = self._get_energy_unit_factor(x_unit)
-
-        energies = np.copy(self.excitation_energies)
-        # Conversion to wavelength in nm is done at the end instead
-        # Since it's not a linear transformation
-        # if x_unit.lower() != 'nm':
-        #    sigma *= energy_unit_factor
-        #    energies *= energy_unit_factor
-
-        # TODO: How to determine this properly to cover a given interval?
-        n_sample = 500
-        x = np.linspace(x_min, x_max, num=n_sample)
-        y = np.zeros(len(x))
-
-        normalization_factor = (
-            1 / np.sqrt(2 * scipy.constants.pi) / sigma / self.nsample
+    @contextmanager
+    def hold_updates(self):
+        """Batch all figure updates within this context
+        into a single push to the browser"""
+        with self._hold_lock:
+            self._hold_count += 1
+        try:
+            yield
+        finally:
+            with self._hold_lock:
+                self._hold_count -= 1
+                push = self._hold_count == 0 and self._update_pending
+                if push:
+                    self._update_pending = False
+            if push:
+                self.update()
+
+
+def canonicalize_smiles(smiles):
+    """Returns canonical SMILES if RDKit is available,
+    otherwise the SMILES is returned unchanged"""
+    try:
+        from rdkit import Chem
+    except ImportError:
+        return smiles
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return smiles
+    return Chem.MolToSmiles(mol)
+
+
+class ExperimentalSpectrumCache:
+    """Process-wide cache of experimental spectra stored in AiiDA DB
+    as XyData nodes with a 'smiles' extra.
+
+    The first lookup indexes SMILES of all XyData nodes with a single
+    projected query. Afterwards, at most every INDEX_REFRESH_INTERVAL seconds,
+    a lookup queries XyData nodes modified since then (by their mtime),
+    so newly added spectra and changed 'smiles' extras are picked up,
+    including extras set only after the node was stored.
+    Nodes and their spectra are loaded from the DB only once,
+    repeated lookups are served from memory.
+    Call clear() to pick up deleted nodes."""
+
+    # In seconds
+    INDEX_REFRESH_INTERVAL = 10.0
+
+    def __init__(self):
+        self._lock = Lock()
+        # Canonical SMILES -> sorted list of XyData pks, i.e. in the order
+        # they were stored
+        self._index = {}
+        # XyData pk -> its indexed canonical SMILES, so that the pk can be
+        # removed from the index when the 'smiles' extra changes
+        self._smiles = {}
+        # XyData pk -> (node, (energies in eV, cross sections)),
+        # or None if the node was deleted or does not contain a valid spectrum
+        self._spectra = {}
+        # Latest mtime of indexed XyData nodes, as stored in the DB,
+        # so that the refresh does not depend on the local clock
+        self._max_mtime = None
+        self._last_update = None
+
+    def find(self, smiles):
+        """Returns a tuple of XyData node and spectrum (energy in eV, cross section)
+        for a given SMILES, or None if not found.
+        If there are multiple spectra, the first stored valid one is returned."""
+        key = canonicalize_smiles(smiles)
+        with self._lock:
+            self._update_index()
+            pks = list(self._index.get(key, ()))
+        for pk in pks:
+            with self._lock:
+                cached = pk in self._spectra
+                found = self._spectra.get(pk)
+            if not cached:
+                found = self._load(pk)
+            if found is not None:
+                return found
+        return None
+
+    def get_spectrum(self, node):
+        """Returns spectrum (energy in eV, cross section) from a given XyData node"""
+        with self._lock:
+            found = self._spectra.get(node.pk)
+        if found is not None:
+            return found[1]
+        spectrum = self._load_spectrum(node)
+        with self._lock:
+            self._spectra[node.pk] = None if spectrum is None else (node, spectrum)
+        return spectrum
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._smiles.clear()
+            self._spectra.clear()
+            self._max_mtime = None
+            self._last_update = None
+
+    def _load(self, pk):
+        """Load XyData node and its spectrum from the DB and cache them"""
+        try:
+            node = load_node(pk)
+        except NotExistent:
+            node = None
+        spectrum = None if node is None else self._load_spectrum(node)
+        found = None if spectrum is None else (node, spectrum)
+        with self._lock:
+            self._spectra[pk] = found
+        return found
+
+    def _update_index(self):
+        """Index SMILES of XyData nodes stored or modified since the last update"""
+        now = time.monotonic()
+        if (
+            self._last_update is not None
+            and now - self._last_update < self.INDEX_REFRESH_INTERVAL
+        ):
+            return
+        self._last_update = now
+        # TODO: Should we subclass XyData specifically for UV/Vis spectra?
+        # Or should we differentiate from other possible Xy nodes
+        # by looking at attributes or extras? Maybe label?
+        # Nodes modified at the same time as the latest indexed one
+        # are queried again, since others might have been stored afterwards
+        # with the same mtime. Indexing them again does not change anything.
+        filters = {}
+        if self._max_mtime is not None:
+            filters["mtime"] = {">=": self._max_mtime}
+        qb = QueryBuilder()
+        qb.append(
+            XyData,
+            filters=filters,
+            project=["id", "extras.smiles", "mtime"],
+            tag="xy",
         )
-        # TODO: Support other intensity units
-        unit_factor = self.COEFF_NEW
-        for exc_energy, osc_strength in zip(energies, self.osc_strengths):
-            prefactor = normalization_factor * unit_factor * osc_strength
-            y += prefactor * np.exp(-((x - exc_energy) ** 2) / 2 / sigma**2)
-
-        if x_unit.lower() == "nm":
-            x, y = self._convert_to_nanometers(x, y)
-        else:
-            x *= energy_unit_factor
-
-        return x, y
-
-    def get_lorentzian_spectrum(self, tau, x_unit, y_unit):
-        """Returns Gaussian broadened spectrum"""
-        # TODO: Determine x_min automatically based on transition energies
-        # and x_units
-        x_min, x_max = self._get_energy_range(x_unit)
-
-        # Conversion factor from eV to given energy unit
-        # (should probably switch to atomic units as default)
-        energy_unit_factor = self._get_energy_unit_factor(x_unit)
-
-        energies = np.copy(self.excitation_energies)
-
-        # TODO: How to determine this properly to cover a given interval?
-        n_sample = 500
-        x = np.linspace(x_min, x_max, num=n_sample)
-        y = np.zeros(len(x))
-
-        normalization_factor = tau / 2 / scipy.constants.pi / self.nsample
-        unit_factor = self.COEFF_NEW
-
-        for exc_energy, osc_strength in zip(energies, self.osc_strengths):
-            prefactor = normalization_factor * unit_factor * osc_strength
-            y += prefactor / ((x - exc_energy) ** 2 + (tau**2) / 4)
-
-        if x_unit.lower() == "nm":
-            x, y = self._convert_to_nanometers(x, y)
-        else:
-            x *= energy_unit_factor
-
-        return x, y
-
-    def _convert_to_nanometers(self, x, y):
-        x = self._get_energy_unit_factor("nm") / x
-        # Filtering out ultralong wavelengths
-        # TODO: Generalize this based on self.transitions
-        nm_thr = 1000
-        to_delete = []
-        for i in range(len(x)):
-            if x[i] > nm_thr:
-                to_delete.append(i)
-        x = np.delete(x, to_delete)
-        y = np.delete(y, to_delete)
-        return x, y
+        for pk, smiles, mtime in qb.iterall():
+            if self._max_mtime is None or mtime > self._max_mtime:
+                self._max_mtime = mtime
+            self._index_smiles(pk, canonicalize_smiles(smiles) if smiles else None)
+
+    def _index_smiles(self, pk, smiles):
+        old_smiles = self._smiles.get(pk)
+        if old_smiles == smiles:
+            return
+        if old_smiles is not None:
+            self._index[old_smiles].remove(pk)
+            if not self._index[old_smiles]:
+                del self._index[old_smiles]
+        if smiles is None:
+            self._smiles.pop(pk, None)
+            return
+        self._smiles[pk] = smiles
+        bisect.insort(self._index.setdefault(smiles, []), pk)
+
+    @staticmethod
+    def _load_spectrum(node):
+        # TODO: When we're creating spectrum as XyData,
+        # can we choose nicer names for x and y?
+        # This would also serve as a validation.
+        if (
+            "x_array" not in node.get_arraynames()
+            or "y_array_0" not in node.get_arraynames()
+        ):
+            return None
+        energy = node.get_array("x_array")
+        cross_section = node.get_array("y_array_0")
+        # TODO: Extract units
+        # TODO: We really need to define units as Enum and use them
+        # consistently everywhere.
+        # data_energy_unit = spectrum.node.get_attribute('x_units')
+        # cross_section_unit = spectrum.node.get_attribute('y_units')
+
+        # Experimental spectra are stored in nanometers. We convert them to eV
+        # only once, the same as theoretical spectra, so that changing
+        # energy units does not require reloading the data.
+        return convert_energy_unit(energy, cross_section, "eV", from_unit="nm")
+
+
+EXPERIMENTAL_SPECTRA = ExperimentalSpectrumCache()
+
+
+class Transitions(traitlets.TraitType):
+    """Trait holding a TransitionSet.
+
+    For convenience, a list of transition dictionaries
+    is also accepted and converted to TransitionSet."""
+
+    default_value = None
+    info_text = "a TransitionSet or a list of transition dictionaries"
+
+    def validate(self, obj, value):
+        if value is None and self.allow_none:
+            return value
+        if isinstance(value, TransitionSet):
+            return value
+        if isinstance(value, (list, tuple)):
+            try:
+                return TransitionSet.from_dicts(value)
+            except ValueError as e:
+                raise traitlets.TraitError(str(e)) from e
+        self.error(obj, value)
 
 
 class SpectrumWidget(ipw.VBox):
 
-    transitions = traitlets.List(allow_none=True)
+    transitions = Transitions(allow_none=True)
     # We use SMILES to find matching experimental spectra
     # that are possibly stored in our DB as XyData.
     smiles = traitlets.Unicode(allow_none=True)
     experimental_spectrum = traitlets.Instance(XyData, allow_none=True)
+    # Ground state energies of conformers in eV, used for Boltzmann weighting.
+    # If None, all conformers have the same weight.
+    conformer_energies = traitlets.List(
+        trait=traitlets.Float(), default_value=None, allow_none=True
+    )
 
     # For now, we do not allow different intensity units
     intensity_unit = "cm^2 per molecule"
 
     THEORY_SPEC_LABEL = "theory"
     EXP_SPEC_LABEL = "experiment"
+    CONFIDENCE_BAND_LABEL = "confidence_band"
+
+    # Maximum number of broadened spectra kept in memory
+    SPECTRUM_CACHE_SIZE = 64
+    # Bootstrap spectra are much bigger, so we keep only a few
+    BOOTSTRAP_CACHE_SIZE = 4
+    # Rapid changes of broadening parameters within this delay (in seconds),
+    # e.g. while dragging the width slider, are coalesced into a single update.
+    RECOMPUTE_DELAY = 0.1
+    # Default temperature in Kelvins for Boltzmann weighting of conformers
+    TEMPERATURE = 298.15
 
     def __init__(self, **kwargs):
+        _init_bokeh_notebook()
+
         title = ipw.HTML(
             """<div style="padding-top: 0px; padding-bottom: 0px">
             <h4>UV/Vis Spectrum</h4></div>"""
         )
 
+        # Broadened spectra as (x, y) tuples with energies in eV,
+        # so that we can change energy units without recomputing them.
+        self._theory_spectrum_ev = None
+        self._experimental_spectrum_ev = None
+        # Confidence band of the theoretical spectrum as (x, lower, upper) in eV
+        self._confidence_band_ev = None
+        self._sampling_error = None
+
+        # Spectrum instance built from current transitions
+        self._spectrum = None
+        # Broadened spectra of individual conformers in eV
+        # for already visited broadening parameters,
+        # keyed by (transitions fingerprint, kernel, width).
+        # They are combined according to conformer populations when plotted,
+        # so that changing temperature does not require recomputation.
+        # Spectra are stored as SpectrumAccumulator instances,
+        # so that transitions can be added incrementally, see add_transitions()
+        self._spectrum_cache = _LRUCache(maxsize=self.SPECTRUM_CACHE_SIZE)
+        # Accumulator already updated with transitions from add_transitions()
+        self._pending_accumulator = None
+        # Bootstrap resampled spectra of individual conformers,
+        # with the same keys as the spectrum cache.
+        self._bootstrap_cache = _LRUCache(maxsize=self.BOOTSTRAP_CACHE_SIZE)
+
+        # Spectra are recomputed in a background thread, see _recompute_loop()
+        # The lock also guards the spectrum cache.
+        self._recompute_lock = Lock()
+        self._recompute_requested = Event()
+        self._recompute_stopped = Event()
+        self._recompute_thread = None
+        self._recompute_request = None
+        self._recompute_generation = 0
+        # Guards the figure and the plotted spectra, which are modified
+        # both by widget callbacks and by the recompute thread.
+        # Must be acquired before _recompute_lock, never while holding it.
+        self._plot_lock = RLock()
+
         self.width_slider = ipw.FloatSlider(
             min=0.05, max=1, step=0.05, value=0.1, description="Width / eV"
         )
@@ -229,6 +405,23 @@ class SpectrumWidget(ipw.VBox):
             ],
         )
 
+        self.temperature_input = ipw.BoundedFloatText(
+            value=self.TEMPERATURE,
+            min=1.0,
+            max=10000.0,
+            step=10.0,
+            description="T / K",
+            tooltip="Temperature for Boltzmann weighting of conformers",
+        )
+
+        self.confidence_band_checkbox = ipw.Checkbox(
+            value=False,
+            description="Show 95% confidence band",
+            tooltip="Bootstrap estimate of the error due to finite number of geometries",
+            indent=False,
+        )
+        self.sampling_error_info = ipw.HTML()
+
         self.energy_unit_selector = ipw.RadioButtons(
             # TODO: Make an enum with different energy units
             options=["eV", "nm", "cm^-1"],
@@ -238,7 +431,15 @@ class SpectrumWidget(ipw.VBox):
 
         controls = ipw.HBox(
             children=[
-                ipw.VBox(children=[self.kernel_selector, self.width_slider]),
+                ipw.VBox(
+                    children=[
+                        self.kernel_selector,
+                        self.width_slider,
+                        self.temperature_input,
+                        self.confidence_band_checkbox,
+                        self.sampling_error_info,
+                    ]
+                ),
                 self.energy_unit_selector,
             ]
         )
@@ -262,6 +463,10 @@ class SpectrumWidget(ipw.VBox):
             self._handle_energy_unit_update, names="value"
         )
         self.width_slider.observe(self._handle_width_update, names="value")
+        self.temperature_input.observe(self._handle_temperature_update, names="value")
+        self.confidence_band_checkbox.observe(
+            self._handle_confidence_band_update, names="value"
+        )
 
         super().__init__(
             [
@@ -274,19 +479,8 @@ class SpectrumWidget(ipw.VBox):
         )
 
     def _validate_transitions(self):
-        # TODO: Maybe use named tuple instead of dictionary?
-        # We should probably make a traitType for this and export it.
-        # https://realpython.com/python-namedtuple/
-        if self.transitions is None or len(self.transitions) == 0:
-            return False
-
-        for tr in self.transitions:
-            if not isinstance(tr, dict) or (
-                "energy" not in tr or "osc_strength" not in tr
-            ):
-                self.debug_print("Invalid transition", tr)
-                return False
-        return True
+        # Individual transitions are validated by the Transitions trait
+        return self.transitions is not None and len(self.transitions) > 0
 
     def _handle_width_update(self, change):
         """Redraw spectra when user changes broadening width via slider"""
@@ -306,46 +500,291 @@ class SpectrumWidget(ipw.VBox):
             energy_unit=self.energy_unit_selector.value,
         )
 
+    def _handle_temperature_update(self, change):
+        """Reweight conformer spectra when user changes temperature.
+        Spectra of individual conformers are not recomputed."""
+        self._build_spectrum()
+        self._plot_spectrum(
+            width=self.width_slider.value,
+            kernel=self.kernel_selector.value,
+            energy_unit=self.energy_unit_selector.value,
+        )
+
+    def _handle_confidence_band_update(self, change):
+        """Show or hide the confidence band, computing it if needed"""
+        self._plot_spectrum(
+            width=self.width_slider.value,
+            kernel=self.kernel_selector.value,
+            energy_unit=self.energy_unit_selector.value,
+        )
+
     def _handle_energy_unit_update(self, change):
         """Updates the spectrum when user changes energy units
-        In this case, we also redraw experimental spectra, if available."""
+        In this case, we also redraw experimental spectra, if available.
+        Spectra are not recomputed, only their energies are transformed."""
 
         energy_unit = change["new"]
         xlabel = f"Energy / {energy_unit}"
-        self.figure.get_figure().xaxis.axis_label = xlabel
-
-        self._plot_spectrum(
-            width=self.width_slider.value,
-            kernel=self.kernel_selector.value,
-            energy_unit=energy_unit,
+        with self._plot_lock, self.figure.hold_updates():
+            self.figure.get_figure().xaxis.axis_label = xlabel
+            self._plot_theory_spectrum(energy_unit, self._spectrum)
+            self._plot_experimental_spectrum_in_unit(energy_unit)
+
+    def _build_spectrum(self):
+        """Create Spectrum from current transitions,
+        invalidating cached spectra if transitions changed"""
+        if not self._validate_transitions():
+            self._spectrum = None
+            self._clear_caches()
+            return
+        # Number of geometries of each conformer is determined from transitions
+        spectrum = Spectrum(
+            self.transitions, conformer_weights=self._get_conformer_weights()
         )
-        if self.experimental_spectrum is not None:
-            self._plot_experimental_spectrum(
-                spectrum_node=self.experimental_spectrum, energy_unit=energy_unit
+        if self._spectrum is None or (
+            self._spectrum.fingerprint() != spectrum.fingerprint()
+        ):
+            self._clear_caches()
+        self._spectrum = spectrum
+
+    def _clear_caches(self):
+        with self._recompute_lock:
+            self._spectrum_cache.clear()
+            self._bootstrap_cache.clear()
+
+    def _get_conformer_weights(self):
+        """Boltzmann populations of conformers at current temperature"""
+        if self.conformer_energies is None:
+            return None
+        nconformer = int(self.transitions.conformer_indices.max()) + 1
+        if len(self.conformer_energies) != nconformer:
+            self.debug_print(
+                f"Got {len(self.conformer_energies)} conformer energies for {nconformer} conformers, ignoring Boltzmann weights"
             )
+            return None
+        return boltzmann_weights(self.conformer_energies, self.temperature_input.value)
 
     def _plot_spectrum(self, kernel, width, energy_unit):
-        if not self._validate_transitions():
-            self.hide_line(self.THEORY_SPEC_LABEL)
+        """Plot theoretical spectrum if it is cached,
+        otherwise schedule its computation in a background thread."""
+        with self._plot_lock:
+            if self._spectrum is None:
+                self._cancel_recompute()
+                self._theory_spectrum_ev = None
+                self._confidence_band_ev = None
+                with self.figure.hold_updates():
+                    self.hide_line(self.THEORY_SPEC_LABEL)
+                    self._plot_confidence_band(energy_unit, None)
+                return
+
+            if kernel not in ("gaussian", "lorentzian"):
+                self.debug_print("Invalid broadening type")
+                return
+
+            # The spectrum is always computed in eV and cached,
+            # conversion to other units is done when plotting.
+            key = self._get_cache_key(self._spectrum, kernel, width)
+            with_bootstrap = (
+                self.confidence_band_checkbox.value
+                and self._spectrum.can_estimate_sampling_error()
+            )
+            with self._recompute_lock:
+                accumulator = self._spectrum_cache.get(key)
+                bootstrap = self._bootstrap_cache.get(key) if with_bootstrap else None
+            self._set_confidence_band(self._spectrum, bootstrap)
+
+            if accumulator is None or (with_bootstrap and bootstrap is None):
+                self._schedule_recompute(self._spectrum, kernel, width, with_bootstrap)
+            else:
+                # Cached spectrum is more recent than any pending computation
+                self._cancel_recompute()
+            if accumulator is None:
+                return
+            # Confidence band is plotted when computed, but we can already
+            # show the spectrum if it was cached.
+            self._theory_spectrum_ev = self._combine_conformers(
+                self._spectrum, accumulator
+            )
+            self._plot_theory_spectrum(energy_unit, self._spectrum)
+
+    @staticmethod
+    def _combine_conformers(spectrum, accumulator):
+        y = accumulator.get_conformer_spectra(spectrum.nconformer)
+        return accumulator.x, spectrum.combine_conformer_spectra(y)
+
+    def _set_confidence_band(self, spectrum, bootstrap):
+        """Compute confidence band from bootstrap spectra of individual conformers"""
+        if bootstrap is None:
+            self._confidence_band_ev = None
+            self._sampling_error = None
             return
-        # TODO: Need to fix this normalization now that we have multiple conformers!
-        # We should have explicit metadata about number of conformers, number of states, number of geometries
+        x, y = bootstrap
+        lower, upper, error = bootstrap_confidence_band(
+            spectrum.combine_conformer_spectra(y)
+        )
+        self._confidence_band_ev = (x, lower, upper)
+        self._sampling_error = error
+
+    @staticmethod
+    def _get_cache_key(spectrum, kernel, width):
+        # Rounding prevents cache misses due to floating point noise from slider.
+        return (spectrum.fingerprint(), kernel, round(width, 8))
+
+    def _compute_spectrum(self, spectrum, kernel, width):
+        """Returns SpectrumAccumulator with spectra of individual conformers.
+        Large ensembles and Lorentzians are broadened via FFT,
+        so that the cost does not grow with the number of transitions."""
+        return SpectrumAccumulator(spectrum, kernel, width)
+
+    def _cancel_recompute(self):
+        with self._recompute_lock:
+            self._recompute_request = None
+            self._recompute_generation += 1
+
+    def _schedule_recompute(self, spectrum, kernel, width, with_bootstrap=False):
+        """Request recomputation of the spectrum in a background thread.
+        Only the latest request is computed, older ones are dropped.
+        If with_bootstrap is True, bootstrap spectra for the confidence band
+        are computed as well."""
+        with self._recompute_lock:
+            if self._recompute_stopped.is_set():
+                return
+            self._recompute_generation += 1
+            self._recompute_request = (
+                self._recompute_generation,
+                spectrum,
+                kernel,
+                width,
+                with_bootstrap,
+            )
+            if self._recompute_thread is None:
+                self._recompute_thread = Thread(
+                    target=self._recompute_loop, daemon=True
+                )
+                self._recompute_thread.start()
+        self._recompute_requested.set()
+
+    def _recompute_loop(self):
+        """Compute requested spectra in a background thread.
+
+        Rapid successive requests (e.g. when dragging the width slider)
+        are coalesced by waiting until no new request comes
+        for RECOMPUTE_DELAY seconds. Results superseded by a newer request
+        while being computed are cached but not plotted.
+        The thread exits when the widget is closed, see close()."""
         try:
-            nsample = self.transitions[-1]["geom_index"] + 1
-        except KeyError:
-            self.debug_print("Could not determine number of samples")
-            nsample = 1
-
-        spec = Spectrum(self.transitions, nsample)
-        if kernel == "lorentzian":
-            x, y = spec.get_lorentzian_spectrum(width, energy_unit, self.intensity_unit)
-        elif kernel == "gaussian":
-            x, y = spec.get_gaussian_spectrum(width, energy_unit, self.intensity_unit)
-        else:
-            self.debug_print("Invalid broadening type")
+            while True:
+                self._recompute_requested.wait()
+                self._recompute_requested.clear()
+                while self._recompute_requested.wait(self.RECOMPUTE_DELAY):
+                    self._recompute_requested.clear()
+                    if self._recompute_stopped.is_set():
+                        break
+                if self._recompute_stopped.is_set():
+                    return
+                # Errors must not kill the thread,
+                # otherwise the spectrum would never be updated again.
+                try:
+                    self._process_recompute_request()
+                except Exception as e:
+                    self.debug_print(f"Spectrum computation failed: {e}")
+        finally:
+            with self._recompute_lock:
+                self._recompute_thread = None
+
+    def close(self):
+        """Close the widget and stop the background thread computing spectra"""
+        with self._recompute_lock:
+            self._recompute_stopped.set()
+            self._recompute_request = None
+            self._recompute_generation += 1
+            thread = self._recompute_thread
+        self._recompute_requested.set()
+        # Spectrum being computed is finished first
+        if thread is not None and thread is not current_thread():
+            thread.join()
+        super().close()
+
+    def _process_recompute_request(self):
+        with self._recompute_lock:
+            request = self._recompute_request
+            self._recompute_request = None
+        if request is None:
+            return
+
+        generation, spectrum, kernel, width, with_bootstrap = request
+        key = self._get_cache_key(spectrum, kernel, width)
+        with self._recompute_lock:
+            accumulator = self._spectrum_cache.get(key)
+            bootstrap = self._bootstrap_cache.get(key)
+        if accumulator is None:
+            accumulator = self._compute_spectrum(spectrum, kernel, width)
+        if with_bootstrap and bootstrap is None:
+            bootstrap = spectrum.get_bootstrap_spectra(kernel, width)
+
+        with self._plot_lock:
+            with self._recompute_lock:
+                self._spectrum_cache.put(key, accumulator)
+                if bootstrap is not None:
+                    self._bootstrap_cache.put(key, bootstrap)
+                if generation != self._recompute_generation:
+                    return
+            self._theory_spectrum_ev = self._combine_conformers(spectrum, accumulator)
+            self._set_confidence_band(spectrum, bootstrap if with_bootstrap else None)
+            # self._spectrum might have already changed, e.g. in reset(),
+            # so we plot with the spectrum from the request.
+            self._plot_theory_spectrum(self.energy_unit_selector.value, spectrum)
+
+    def _plot_theory_spectrum(self, energy_unit, spectrum):
+        """Plot cached theoretical spectrum in a given energy unit
+        spectrum: Spectrum from which the cached spectrum was computed
+        Must be called with _plot_lock held."""
+        theory_spectrum = self._theory_spectrum_ev
+        if theory_spectrum is None or spectrum is None:
+            return
+        x, y = convert_energy_unit(
+            *theory_spectrum,
+            energy_unit,
+            max_wavelength=spectrum.get_max_wavelength(),
+        )
+        with self.figure.hold_updates():
+            self.plot_line(x, y, self.THEORY_SPEC_LABEL)
+            self._plot_confidence_band(energy_unit, spectrum)
+
+    def _plot_confidence_band(self, energy_unit, spectrum):
+        """Plot confidence band of the theoretical spectrum as a shaded area,
+        or hide it if it is not available. Must be called with _plot_lock held."""
+        band = self.figure.get_figure().select_one({"name": self.CONFIDENCE_BAND_LABEL})
+        confidence_band = self._confidence_band_ev
+        if confidence_band is None or spectrum is None:
+            self.sampling_error_info.value = ""
+            if (
+                spectrum is not None
+                and self.confidence_band_checkbox.value
+                and not spectrum.can_estimate_sampling_error()
+            ):
+                self.sampling_error_info.value = "Relative sampling error: undefined (at least 2 geometries of each conformer needed)"
+            if band.visible:
+                band.visible = False
+                self.figure.update()
             return
 
-        self.plot_line(x, y, self.THEORY_SPEC_LABEL)
+        x, lower, upper = confidence_band
+        x, y = convert_energy_unit(
+            x,
+            np.vstack([lower, upper]),
+            energy_unit,
+            max_wavelength=spectrum.get_max_wavelength(),
+        )
+        band.data_source.data = {
+            "x": np.ascontiguousarray(x),
+            "y1": np.ascontiguousarray(y[0]),
+            "y2": np.ascontiguousarray(y[1]),
+        }
+        band.visible = True
+        self.figure.update()
+        nsample = int(spectrum.nsample.sum())
+        self.sampling_error_info.value = f"Relative sampling error: {self._sampling_error:.1%} ({nsample} geometries)"
 
     def debug_print(self, *args):
         with self.debug_output:
@@ -361,22 +800,41 @@ class SpectrumWidget(ipw.VBox):
 
         **args additional arguments are passed into Figure.line()"""
         # https://docs.bokeh.org/en/latest/docs/reference/models/renderers.html?highlight=renderers#renderergroup
-        f = self.figure.get_figure()
-        line = f.select_one({"name": label})
-        if line is None:
-            line = f.line(x, y, line_width=2, name=label, **args)
-        line.visible = True
-        line.data_source.data = {"x": x, "y": y}
-        self.figure.update()
+        # Bokeh transfers contiguous NumPy arrays in binary form,
+        # whereas Python lists would be serialized element by element.
+        x = np.ascontiguousarray(x, dtype=float)
+        y = np.ascontiguousarray(y, dtype=float)
+        with self._plot_lock:
+            f = self.figure.get_figure()
+            line = f.select_one({"name": label})
+            if line is None:
+                line = f.line(x, y, line_width=2, name=label, **args)
+            else:
+                self._update_line_data(line.data_source, x, y)
+            line.visible = True
+            self.figure.update()
+
+    @staticmethod
+    def _update_line_data(source, x, y):
+        """Update ColumnDataSource so that only changed columns
+        are sent to the browser on the next push"""
+        old_x = source.data.get("x")
+        if old_x is None or len(old_x) != len(x):
+            source.data = {"x": x, "y": y}
+            return
+        if x is not old_x and not np.array_equal(x, old_x):
+            source.data["x"] = x
+        source.data["y"] = y
 
     def hide_line(self, label):
         """Hide given line from the plot"""
-        f = self.figure.get_figure()
-        line = f.select_one({"name": label})
-        if line is None or not line.visible:
-            return
-        line.visible = False
-        self.figure.update()
+        with self._plot_lock:
+            f = self.figure.get_figure()
+            line = f.select_one({"name": label})
+            if line is None or not line.visible:
+                return
+            line.visible = False
+            self.figure.update()
 
     def remove_line(self, label):
         # This approach is potentially britle, see:
@@ -384,15 +842,18 @@ class SpectrumWidget(ipw.VBox):
         # Observation: Removing and adding lines via
         # plot_line() and remove_line() works well. However, doing
         # updates on existing lines only works for lines defined in _init_figure()
-        f = self.figure.get_figure()
-        line = f.select_one({"name": label})
-        if line is None:
-            return
-        f.renderers.remove(line)
-        self.figure.update()
+        with self._plot_lock:
+            f = self.figure.get_figure()
+            line = f.select_one({"name": label})
+            if line is None:
+                return
+            f.renderers.remove(line)
+            self.figure.update()
 
     def _init_figure(self, *args, **kwargs):
         """Initialize Bokeh figure. Arguments are passed to bokeh.plt.figure()"""
+        import bokeh.plotting as plt
+
         self.figure = BokehFigureContext(plt.figure(*args, **kwargs))
         f = self.figure.get_figure()
         f.xaxis.axis_label = f"Energy / {self.energy_unit_selector.value}"
@@ -409,18 +870,66 @@ class SpectrumWidget(ipw.VBox):
         # https://doi.org/10.1038/s41467-020-19160-7
         theory_line = f.line(x, y, line_width=2, name=self.THEORY_SPEC_LABEL)
         theory_line.visible = False
+        confidence_band = f.varea(
+            x=x, y1=y, y2=y, fill_alpha=0.3, name=self.CONFIDENCE_BAND_LABEL
+        )
+        confidence_band.visible = False
 
     def reset(self):
         with self.hold_trait_notifications():
             self.transitions = None
+            self.conformer_energies = None
             self.smiles = None
 
-        self.hide_line(self.THEORY_SPEC_LABEL)
-        self.remove_line(self.EXP_SPEC_LABEL)
+        with self._plot_lock, self.figure.hold_updates():
+            self._theory_spectrum_ev = None
+            self._experimental_spectrum_ev = None
+            self._confidence_band_ev = None
+            self.hide_line(self.THEORY_SPEC_LABEL)
+            self._plot_confidence_band(self.energy_unit_selector.value, None)
+            self.remove_line(self.EXP_SPEC_LABEL)
         self.debug_output.clear_output()
 
-    @traitlets.observe("transitions")
+    def add_transitions(self, transitions):
+        """Add new transitions, e.g. from a just finished calculation,
+        to the current ones. Only the new transitions are broadened
+        and added to the currently plotted spectrum, unless they fall
+        outside of its energy range.
+
+        Geometry indices must not clash with geometries
+        that are already included, since they determine normalization."""
+        if not self._validate_transitions() or self._spectrum is None:
+            self.transitions = transitions
+            return
+        if len(transitions) == 0:
+            return
+
+        key = self._get_cache_key(
+            self._spectrum, self.kernel_selector.value, self.width_slider.value
+        )
+        with self._recompute_lock:
+            accumulator = self._spectrum_cache.get(key)
+        # This might be called from a different thread than the recompute worker,
+        # which can be reading the cached accumulator at the same time,
+        # so the new transitions are added to a copy.
+        if accumulator is not None:
+            accumulator = accumulator.copy()
+            if accumulator.add(transitions):
+                self._pending_accumulator = accumulator
+        self.transitions = TransitionSet.concatenate([self.transitions, transitions])
+
+    @traitlets.observe("transitions", "conformer_energies")
     def _observe_transitions(self, change):
+        accumulator, self._pending_accumulator = self._pending_accumulator, None
+        self._build_spectrum()
+        if accumulator is not None and self._spectrum is not None:
+            # Transitions were only extended by add_transitions(),
+            # the accumulator already contains the new ones.
+            key = self._get_cache_key(
+                self._spectrum, accumulator.kernel, accumulator.width
+            )
+            with self._recompute_lock:
+                self._spectrum_cache.put(key, accumulator)
         self._plot_spectrum(
             width=self.width_slider.value,
             kernel=self.kernel_selector.value,
@@ -431,62 +940,41 @@ class SpectrumWidget(ipw.VBox):
     def _observe_smiles(self, change):
         self._find_experimental_spectrum(change["new"])
 
-    # TODO: Make sure that this does not slow us down too much
     def _find_experimental_spectrum(self, smiles):
         """Find an experimental spectrum for a given SMILES
         and plot it if it is available in our DB"""
         if smiles is None or smiles == "":
+            self._experimental_spectrum_ev = None
             self.remove_line(self.EXP_SPEC_LABEL)
             return
 
-        qb = QueryBuilder()
-        # TODO: Should we subclass XyData specifically for UV/Vis spectra?
-        # Or should we differentiate from other possible Xy nodes
-        # by looking at attributes or extras? Maybe label?
-        qb.append(XyData, filters={"extras.smiles": smiles})
-
-        if qb.count() == 0:
+        # TODO: For now let's just assume we have one
+        # canonical experimental spectrum per compound.
+        found = EXPERIMENTAL_SPECTRA.find(smiles)
+        if found is None:
+            self._experimental_spectrum_ev = None
             self.remove_line(self.EXP_SPEC_LABEL)
             return
 
-        # for spectrum in qb.iterall():
-        # TODO: For now let's just assume we have one
-        # canonical experimental spectrum per compound.
-        self.experimental_spectrum = qb.first()[0]
-        self._plot_experimental_spectrum(
-            spectrum_node=self.experimental_spectrum,
-            energy_unit=self.energy_unit_selector.value,
-        )
+        self.experimental_spectrum, self._experimental_spectrum_ev = found
+        self._plot_experimental_spectrum_in_unit(self.energy_unit_selector.value)
 
     def _plot_experimental_spectrum(self, spectrum_node, energy_unit):
         """Render experimental spectrum that was loaded to AiiDA database manually
         param: spectrum_node: XyData node
         energy_unit: energy unit of the plotted spectra"""
-        # TODO: When we're creating spectrum as XyData,
-        # can we choose nicer names for x and y?
-        # This would also serve as a validation.
+        self._experimental_spectrum_ev = EXPERIMENTAL_SPECTRA.get_spectrum(
+            spectrum_node
+        )
+        self._plot_experimental_spectrum_in_unit(energy_unit)
 
-        if (
-            "x_array" not in spectrum_node.get_arraynames()
-            or "y_array_0" not in spectrum_node.get_arraynames()
-        ):
+    def _plot_experimental_spectrum_in_unit(self, energy_unit):
+        """Plot cached experimental spectrum in a given energy unit"""
+        if self._experimental_spectrum_ev is None:
             return
-        energy = spectrum_node.get_array("x_array")
-        cross_section = spectrum_node.get_array("y_array_0")
-        # TODO: Extract units
-        # TODO: We really need to define units as Enum and use them
-        # consistently everywhere.
-        # data_energy_unit = spectrum.node.get_attribute('x_units')
-        # cross_section_unit = spectrum.node.get_attribute('y_units')
-
-        # TODO: Refactor how units are handled in this file for forks sake!
-        # We should decouple changing units from spectra plotting in general
-        # (e.g. do not recalculate the intensity of theoretical spectrum
-        # when units are changed)!
-        if energy_unit.lower() == "ev":
-            energy = 1239.8 / energy
-        elif energy_unit.lower() == "cm^-1":
-            energy = 8065.7 * 1239.8 / energy
+        energy, cross_section = convert_energy_unit(
+            *self._experimental_spectrum_ev, energy_unit
+        )
 
         line_options = {
             "line_color": "orange",
@@ -0,0 +1,912 @@
+"""Broadening of UV/Vis spectra from electronic transitions.
+
+This module depends only on NumPy and SciPy so that spectra can be
+computed in batch scripts and workflows, without Jupyter or Bokeh.
+Interactive plotting is implemented in aiidalab_ispg.spectrum.
+
+Authors:
+    * Daniel Hollas <daniel.hollas@durham.ac.uk>
+"""
+from collections.abc import Mapping
+import copy
+import hashlib
+
+import numpy as np
+import scipy
+from scipy import constants
+
+from aiidalab_ispg.units import EV_TO_CM, convert_energy_unit, get_energy_unit_factor
+
+
+# Upper bound on the number of elements of the temporary
+# (transitions x grid points) array that is evaluated at once
+# during broadening, i.e. 512 kB for double precision,
+# so that the block stays in CPU cache.
+BROADENING_BLOCK_SIZE = 2**16
+
+# Default cutoffs for truncated broadening kernels in units of kernel width.
+# Gaussian is below 1e-7 of its maximum beyond 6 sigma.
+GAUSSIAN_CUTOFF = 6.0
+# Lorentzian tails decay slowly, truncating at 100 FWHM
+# loses ~0.3% of the intensity, see Spectrum.lorentzian_truncation_error()
+LORENTZIAN_CUTOFF = 100.0
+
+# Number of points per kernel width of the fine grid used in FFT broadening
+FFT_POINTS_PER_WIDTH = 20
+# Above this number of transitions, SpectrumAccumulator broadens
+# Gaussians via FFT, whose cost does not depend on the number of transitions.
+FFT_MIN_TRANSITIONS = 1000
+
+# Target relative error of linear interpolation between energy grid points
+# at the maximum of a broadening kernel, determines the grid spacing.
+GRID_ERROR = 5e-3
+MIN_GRID_SIZE = 100
+MAX_GRID_SIZE = 20000
+# In non-uniform grids, keep only every n-th grid point further than
+# NONUNIFORM_GRID_CUTOFF kernel widths from any transition.
+NONUNIFORM_GRID_CUTOFF = 5.0
+NONUNIFORM_GRID_COARSENING = 4
+
+# Default number of bootstrap resamples for confidence bands
+BOOTSTRAP_SAMPLES = 200
+
+# Spectra in nm are plotted up to this multiple
+# of the wavelength of the lowest transition
+WAVELENGTH_RANGE_FACTOR = 2.0
+
+
+def _gaussian_kernel(delta, sigma):
+    """Evaluate unnormalized Gaussian exp(-delta^2 / 2 sigma^2)
+    in place, overwriting the input array"""
+    np.square(delta, out=delta)
+    delta *= -0.5 / sigma**2
+    return np.exp(delta, out=delta)
+
+
+def _lorentzian_kernel(delta, tau):
+    """Evaluate unnormalized Lorentzian 1 / (delta^2 + tau^2 / 4)
+    in place, overwriting the input array"""
+    np.square(delta, out=delta)
+    delta += tau**2 / 4
+    return np.reciprocal(delta, out=delta)
+
+
+def _get_kernel_parameters(kernel, width, grid_error=GRID_ERROR):
+    """Returns kernel function, its normalization factor and grid spacing
+    for a given kernel name ("gaussian" or "lorentzian") and width in eV"""
+    if kernel == "gaussian":
+        normalization_factor = 1 / np.sqrt(2 * scipy.constants.pi) / width
+        # Linear interpolation error at the Gaussian peak is dx^2 / (8 sigma^2)
+        spacing = width * np.sqrt(8 * grid_error)
+        return _gaussian_kernel, normalization_factor, spacing
+    elif kernel == "lorentzian":
+        normalization_factor = width / 2 / scipy.constants.pi
+        # Linear interpolation error at the Lorentzian peak is dx^2 / tau^2
+        spacing = width * np.sqrt(grid_error)
+        return _lorentzian_kernel, normalization_factor, spacing
+    raise ValueError(f"Invalid broadening kernel '{kernel}'")
+
+
+def _add_to_rows(y, indices, values):
+    """Add values to a flattened array of spectra y at given indices,
+    summing duplicate indices. Only the part of y between the smallest
+    and largest index is touched, so when transitions are sorted by rows,
+    the cost does not depend on the number of spectra."""
+    start = indices.min()
+    end = indices.max() + 1
+    y[start:end] += np.bincount(
+        (indices - start).ravel(), weights=values.ravel(), minlength=end - start
+    )
+
+
+def _broaden(x, energies, intensities, kernel, width, rows=None, nrows=1):
+    """Sum broadening kernels centered at transition energies
+    and scaled by intensities on a grid x.
+
+    All transitions are evaluated against the whole grid at once,
+    in blocks of transitions so that the temporary array
+    never exceeds BROADENING_BLOCK_SIZE elements.
+
+    If rows is given, transitions are summed into nrows separate spectra,
+    i-th transition contributing to the spectrum rows[i],
+    and an array of shape (nrows, len(x)) is returned."""
+    if rows is not None:
+        y = np.zeros(nrows * len(x))
+        order = np.argsort(rows, kind="stable")
+        energies, intensities, rows = energies[order], intensities[order], rows[order]
+        grid_indices = np.arange(len(x))
+    else:
+        y = np.zeros(len(x))
+    block_size = max(1, BROADENING_BLOCK_SIZE // max(1, len(x)))
+    for start in range(0, len(energies), block_size):
+        end = start + block_size
+        delta = np.subtract.outer(energies[start:end], x)
+        values = kernel(delta, width)
+        if rows is None:
+            # Contract over transitions with a single matrix-vector product
+            y += intensities[start:end] @ values
+        else:
+            values *= intensities[start:end, np.newaxis]
+            indices = rows[start:end, np.newaxis] * len(x) + grid_indices
+            _add_to_rows(y, indices, values)
+    return y if rows is None else y.reshape(nrows, len(x))
+
+
+def _broaden_truncated(
+    x, energies, intensities, kernel, width, cutoff, rows=None, nrows=1
+):
+    """Same as _broaden(), but each kernel is evaluated only
+    within a window (E - cutoff, E + cutoff) around its transition energy.
+
+    The cost scales with number of transitions times the window size
+    instead of the full grid size. Grid points of each window are found by
+    np.searchsorted, which requires x to be sorted. Transition energies
+    should be sorted as well so that neighbouring windows overlap in memory."""
+    shape = len(x) if rows is None else (nrows, len(x))
+    if len(energies) == 0 or len(x) == 0:
+        return np.zeros(shape)
+    if rows is not None:
+        # Stable sort keeps transitions of each spectrum sorted by energy
+        order = np.argsort(rows, kind="stable")
+        energies, intensities, rows = energies[order], intensities[order], rows[order]
+    lower = np.searchsorted(x, energies - cutoff, side="left")
+    upper = np.searchsorted(x, energies + cutoff, side="right")
+    window_size = int((upper - lower).max())
+    if window_size == 0:
+        return np.zeros(shape)
+    # Gathering grid points is slower than dense evaluation
+    # when the windows cover most of the grid anyway.
+    if 2 * window_size > len(x):
+        return _broaden(x, energies, intensities, kernel, width, rows, nrows)
+    y = np.zeros(np.prod(shape))
+    offsets = np.arange(window_size)
+    block_size = max(1, BROADENING_BLOCK_SIZE // window_size)
+    for start in range(0, len(energies), block_size):
+        end = start + block_size
+        indices = lower[start:end, np.newaxis] + offsets
+        outside = indices >= upper[start:end, np.newaxis]
+        np.minimum(indices, len(x) - 1, out=indices)
+        delta = x[indices] - energies[start:end, np.newaxis]
+        values = kernel(delta, width)
+        values *= intensities[start:end, np.newaxis]
+        values[outside] = 0.0
+        if rows is not None:
+            # Each spectrum occupies a separate segment of the flattened output
+            indices += rows[start:end, np.newaxis] * len(x)
+        _add_to_rows(y, indices, values)
+    return y.reshape(shape)
+
+
+def _broaden_fft(x, energies, intensities, kernel, width, cutoff, rows=None, nrows=1):
+    """Same as _broaden(), but computed as a convolution via FFT.
+
+    Intensities are first binned onto a fine uniform grid
+    (linearly distributed between two neighbouring bins),
+    which is then convolved with the kernel truncated at cutoff.
+    The cost is O(G log G) in the number of fine grid points G
+    and does not depend on the number of transitions.
+    The result is linearly interpolated onto the grid x."""
+    if len(energies) == 0 or len(x) == 0:
+        return np.zeros(len(x) if rows is None else (nrows, len(x)))
+    spacing = width / FFT_POINTS_PER_WIDTH
+    if len(x) > 1:
+        spacing = min(spacing, np.min(np.diff(x)))
+    grid_min = min(x[0], energies.min())
+    grid_max = max(x[-1], energies.max())
+    n_grid = int(np.ceil((grid_max - grid_min) / spacing)) + 2
+
+    # Linear binning preserves the total intensity and its first moment
+    position = (energies - grid_min) / spacing
+    index = np.floor(position).astype(int)
+    fraction = position - index
+    if rows is not None:
+        index += rows * n_grid
+    histogram = np.bincount(
+        index, weights=intensities * (1.0 - fraction), minlength=nrows * n_grid
+    )
+    histogram += np.bincount(
+        index + 1, weights=intensities * fraction, minlength=nrows * n_grid
+    )
+    histogram = histogram.reshape(nrows, n_grid)
+
+    # Kernel sampled at offsets -n_kernel..n_kernel,
+    # stored in wrap-around order for the circular convolution
+    n_kernel = min(int(np.ceil(cutoff / spacing)), n_grid - 1)
+    n_fft = 1 << (n_grid + n_kernel).bit_length()
+    kernel_grid = np.zeros(n_fft)
+    offsets = np.arange(n_kernel + 1) * spacing
+    kernel_values = kernel(offsets, width)
+    kernel_grid[: n_kernel + 1] = kernel_values
+    kernel_grid[n_fft - n_kernel :] = kernel_values[:0:-1]
+
+    y_fine = np.fft.irfft(
+        np.fft.rfft(histogram, n_fft) * np.fft.rfft(kernel_grid), n_fft
+    )[:, :n_grid]
+    x_fine = grid_min + np.arange(n_grid) * spacing
+    y = np.array([np.interp(x, x_fine, row) for row in y_fine])
+    return y[0] if rows is None else y
+
+
+def _get_broadening_method(kernel, ntransitions):
+    """Returns the fastest broadening method for a given kernel
+    and number of transitions, see Spectrum.get_gaussian_spectrum().
+
+    Lorentzian tails span the whole grid, so truncated broadening
+    would be as expensive as dense, FFT is used regardless of the number
+    of transitions. Gaussians are evaluated only close to each transition,
+    which is cheaper and exact for a small number of transitions."""
+    if kernel == "lorentzian" or ntransitions >= FFT_MIN_TRANSITIONS:
+        return "fft"
+    return "truncated"
+
+
+def bootstrap_confidence_band(y_bootstrap, confidence=0.95):
+    """Pointwise confidence band from bootstrap resampled spectra
+    of shape (nbootstrap, len(x)).
+
+    Returns lower and upper bound of the band, and a scalar convergence
+    metric, the relative sampling error, defined as the norm of pointwise
+    standard deviations relative to the norm of the mean spectrum."""
+    alpha = (1.0 - confidence) / 2
+    lower, upper = np.quantile(y_bootstrap, [alpha, 1.0 - alpha], axis=0)
+    norm = np.linalg.norm(y_bootstrap.mean(axis=0))
+    error = np.linalg.norm(y_bootstrap.std(axis=0)) / norm if norm > 0.0 else 0.0
+    return lower, upper, error
+
+
+def boltzmann_weights(energies, temperature):
+    """Normalized Boltzmann populations of conformers
+    energies: conformer energies in eV
+    temperature: in Kelvins"""
+    energies = np.asarray(energies, dtype=float)
+    if temperature <= 0.0:
+        raise ValueError("Temperature must be positive")
+    kt = constants.k * temperature / constants.e
+    weights = np.exp(-(energies - energies.min()) / kt)
+    return weights / weights.sum()
+
+
+# Smallest value of TransitionSet.INDEX_DTYPE
+_MIN_INDEX = np.iinfo(np.int32).min
+
+
+class TransitionSet:
+    """Compact array-backed collection of electronic transitions.
+
+    Each transition is a row in contiguous NumPy columns:
+    energies: excitation energies in eV
+    osc_strengths: oscillator strengths
+    geom_indices: index of the molecular geometry (e.g. Wigner sample)
+    conformer_indices: index of the conformer
+    state_indices: index of the excited state in a given geometry
+
+    Instances should be treated as immutable."""
+
+    COLUMNS = (
+        "energies",
+        "osc_strengths",
+        "geom_indices",
+        "conformer_indices",
+        "state_indices",
+    )
+    INDEX_DTYPE = np.int32
+
+    def __init__(
+        self,
+        energies,
+        osc_strengths,
+        geom_indices=None,
+        conformer_indices=None,
+        state_indices=None,
+    ):
+        self.energies = np.ascontiguousarray(energies, dtype=float).reshape(-1)
+        self.osc_strengths = np.ascontiguousarray(osc_strengths, dtype=float).reshape(
+            -1
+        )
+        ntrans = len(self.energies)
+        self.geom_indices = self._index_column(geom_indices, ntrans)
+        self.conformer_indices = self._index_column(conformer_indices, ntrans)
+        self.state_indices = self._index_column(state_indices, ntrans)
+        self.validate()
+
+    @classmethod
+    def _index_column(cls, indices, ntrans):
+        column = np.zeros(ntrans, dtype=cls.INDEX_DTYPE)
+        if indices is not None:
+            # Scalar index is broadcasted to all transitions
+            column[:] = indices
+        return column
+
+    def validate(self):
+        """Raise ValueError if transitions are inconsistent"""
+        ntrans = len(self.energies)
+        for name in self.COLUMNS:
+            if len(getattr(self, name)) != ntrans:
+                raise ValueError(f"Inconsistent number of {name} and energies")
+        if not np.all(np.isfinite(self.energies)):
+            raise ValueError("Excitation energies must be finite")
+        if not np.all(np.isfinite(self.osc_strengths)):
+            raise ValueError("Oscillator strengths must be finite")
+
+    @classmethod
+    def from_dicts(cls, transitions):
+        """Create TransitionSet from a list of dictionaries with keys
+        'energy', 'osc_strength' and optionally 'geom_index'"""
+        try:
+            energies = [tr["energy"] for tr in transitions]
+            osc_strengths = [tr["osc_strength"] for tr in transitions]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid transition: {e}") from e
+        geom_indices = [tr.get("geom_index", 0) for tr in transitions]
+        return cls(energies, osc_strengths, geom_indices=geom_indices)
+
+    @classmethod
+    def from_orca_output(cls, output_dict, geom_index=0, conformer_index=0):
+        """Create TransitionSet from ORCA TDDFT output parameters
+        with excitation energies in cm^-1"""
+        # TODO: Use atomic units both for energies and osc. strengths
+        en = np.asarray(output_dict["etenergies"], dtype=float)
+        osc = output_dict["etoscs"]
+        if len(en) != len(osc):
+            raise ValueError("Inconsistent number of energies and osc. strengths")
+        return cls(
+            energies=en / EV_TO_CM,
+            osc_strengths=osc,
+            geom_indices=geom_index,
+            conformer_indices=conformer_index,
+            state_indices=np.arange(len(en)),
+        )
+
+    @classmethod
+    def from_wigner_outputs(cls, wigner_outputs, conformer_index=0):
+        """Create TransitionSet from a list of ORCA outputs,
+        one per Wigner geometry"""
+        return cls.concatenate(
+            cls.from_orca_output(params, i, conformer_index)
+            for i, params in enumerate(wigner_outputs)
+        )
+
+    @classmethod
+    def from_spectrum_data(cls, spectrum_data):
+        """Create TransitionSet from the spectrum_data output of AtmospecWorkChain,
+        i.e. a mapping of arrays named as TransitionSet.COLUMNS.
+        Older workflows stored a list of Wigner outputs for each conformer."""
+        if isinstance(spectrum_data, Mapping):
+            return cls(
+                **{
+                    name: spectrum_data[name]
+                    for name in cls.COLUMNS
+                    if name in spectrum_data
+                }
+            )
+        return cls.concatenate(
+            cls.from_wigner_outputs(conformer, conformer_index=i)
+            for i, conformer in enumerate(spectrum_data)
+        )
+
+    @classmethod
+    def concatenate(cls, transition_sets):
+        """Join multiple TransitionSets into a single one"""
+        transition_sets = list(transition_sets)
+        if not transition_sets:
+            return cls([], [])
+        return cls(
+            *(
+                np.concatenate([getattr(ts, column) for ts in transition_sets])
+                for column in cls.COLUMNS
+            )
+        )
+
+    def _get_geometry_keys(self):
+        """Returns a single integer key of the geometry of each transition,
+        encoding its (conformer index, geometry index) pair.
+        Keys are ordered the same as the pairs, see get_geometries()"""
+        # Finding unique keys is more than ten times faster
+        # than np.unique(axis=0) on the pairs themselves.
+        keys = self.conformer_indices.astype(np.int64) << 32
+        keys += self.geom_indices.astype(np.int64) - _MIN_INDEX
+        return keys
+
+    @staticmethod
+    def _decode_geometry_keys(keys):
+        conformers = keys >> 32
+        geoms = (keys & 0xFFFFFFFF) + _MIN_INDEX
+        return np.stack([conformers, geoms], axis=1).astype(TransitionSet.INDEX_DTYPE)
+
+    def get_geometries(self, return_inverse=False):
+        """Returns distinct (conformer index, geometry index) pairs
+        as an array of shape (ngeom, 2), sorted by conformer and geometry.
+        If return_inverse is True, also returns the index of the geometry
+        of each transition in this array."""
+        if return_inverse:
+            keys, inverse = np.unique(self._get_geometry_keys(), return_inverse=True)
+            return self._decode_geometry_keys(keys), inverse.reshape(-1)
+        return self._decode_geometry_keys(np.unique(self._get_geometry_keys()))
+
+    def __len__(self):
+        return len(self.energies)
+
+
+class Spectrum(object):
+    AUtoCm = 8.478354e-30
+    COEFF = (
+        constants.pi
+        * AUtoCm**2
+        * 1e4
+        / (3 * scipy.constants.hbar * scipy.constants.epsilon_0 * scipy.constants.c)
+    )
+    # Transition Dipole to Osc. Strength in atomic units
+    COEFF_NEW = COEFF * 3 / 2
+    # COEFF =  scipy.constants.pi * AUtoCm**2 * 1e4 * scipy.constants.hbar / (2 * scipy.constants.epsilon_0 * scipy.constants.c * scipy.constants.m_e)
+
+    def __init__(self, transitions, nsample=None, conformer_weights=None):
+        """transitions: TransitionSet or a list of dictionaries
+        nsample: number of geometries of each conformer used for normalization,
+        either a single number or one per conformer.
+        If None, it is the number of distinct geometries of each conformer.
+        conformer_weights: populations of conformers, e.g. from boltzmann_weights().
+        If None, all conformers have the same weight.
+        Conformers without any geometries get zero weight."""
+        if not isinstance(transitions, TransitionSet):
+            transitions = TransitionSet.from_dicts(transitions)
+        self.transitions = transitions
+        # Excitation energies in eV
+        self.excitation_energies = transitions.energies
+        # Oscillator strengths
+        self.osc_strengths = transitions.osc_strengths
+        self.conformer_indices = transitions.conformer_indices
+
+        nconformer = 1
+        if len(transitions) > 0:
+            nconformer = int(self.conformer_indices.max()) + 1
+        if conformer_weights is not None:
+            if len(conformer_weights) < nconformer:
+                raise ValueError(
+                    f"Expected {nconformer} conformer weights, got {len(conformer_weights)}"
+                )
+            nconformer = len(conformer_weights)
+        self.nconformer = nconformer
+
+        # Number of molecular geometries sampled from ground state distribution
+        # for each conformer
+        if nsample is None:
+            nsample = np.bincount(
+                transitions.get_geometries()[:, 0], minlength=nconformer
+            )
+        self.nsample = np.broadcast_to(np.asarray(nsample, dtype=int), (nconformer,))
+
+        if conformer_weights is None:
+            conformer_weights = np.ones(nconformer)
+        conformer_weights = np.asarray(conformer_weights, dtype=float)
+        if np.any(conformer_weights < 0.0) or conformer_weights.sum() <= 0.0:
+            raise ValueError("Conformer weights must be non-negative")
+        # Conformers without any geometries, e.g. while their calculations
+        # are still running, do not contribute and must not scale down
+        # the spectrum, so the remaining conformers are renormalized.
+        has_samples = self.nsample > 0
+        if np.any(conformer_weights[has_samples] > 0.0):
+            conformer_weights = np.where(has_samples, conformer_weights, 0.0)
+        self.conformer_weights = conformer_weights / conformer_weights.sum()
+
+        # Transitions sorted by energy, computed lazily for truncated broadening
+        self._sort_order = None
+        self._sorted_energies = None
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """Returns a hash identifying the set of transitions
+        and their normalization, e.g. for caching broadened spectra.
+
+        Conformer weights are not included, since spectra
+        of individual conformers do not depend on them."""
+        if self._fingerprint is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(self.excitation_energies.tobytes())
+            h.update(self.osc_strengths.tobytes())
+            h.update(self.conformer_indices.tobytes())
+            h.update(self.nsample.tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def combine_conformer_spectra(self, y):
+        """Sum spectra of individual conformers,
+        as returned with per_conformer=True, weighted by conformer populations.
+        This is cheap, so that e.g. the temperature can be changed
+        without broadening the spectra again.
+        Works also for bootstrap spectra from get_bootstrap_spectra()."""
+        return np.tensordot(self.conformer_weights, y, axes=1)
+
+    def can_estimate_sampling_error(self):
+        """Bootstrap needs at least two geometries of each conformer
+        contributing to the spectrum, with a single geometry all resamples
+        are identical and the sampling error would be reported as zero."""
+        return bool(np.all(self.nsample[self.conformer_weights > 0.0] >= 2))
+
+    def get_bootstrap_spectra(
+        self,
+        kernel,
+        width,
+        nbootstrap=BOOTSTRAP_SAMPLES,
+        seed=0,
+        grid_error=GRID_ERROR,
+    ):
+        """Bootstrap estimate of the error due to finite sampling of geometries.
+
+        Geometries of each conformer are resampled with replacement
+        nbootstrap times. Spectra of individual geometries are broadened
+        only once, all resamples are then computed as a single product
+        of a matrix of multinomial counts with the geometry spectra.
+
+        kernel: "gaussian" or "lorentzian"
+        width: broadening width in eV
+        Returns energy grid in eV and resampled spectra of individual conformers
+        as an array of shape (nconformer, nbootstrap, len(x)),
+        see combine_conformer_spectra() and bootstrap_confidence_band().
+        The estimate is meaningless unless can_estimate_sampling_error()"""
+        kernel_function, normalization_factor, spacing = _get_kernel_parameters(
+            kernel, width, grid_error
+        )
+        cutoff = GAUSSIAN_CUTOFF if kernel == "gaussian" else LORENTZIAN_CUTOFF
+        x = self._get_energy_grid(spacing, width)
+
+        geometries, rows = self.transitions.get_geometries(return_inverse=True)
+        order = self._get_sort_order()
+        # TODO: Support other intensity units
+        intensities = normalization_factor * self.COEFF_NEW * self.osc_strengths
+        geometry_spectra = _broaden_truncated(
+            x,
+            self._get_sorted_energies(),
+            intensities[order],
+            kernel_function,
+            width,
+            cutoff * width,
+            rows=rows[order],
+            nrows=len(geometries),
+        )
+
+        rng = np.random.default_rng(seed)
+        y = np.zeros((self.nconformer, nbootstrap, len(x)))
+        for conformer in range(self.nconformer):
+            (indices,) = np.nonzero(geometries[:, 0] == conformer)
+            nsample = len(indices)
+            if nsample == 0:
+                continue
+            counts = rng.multinomial(
+                nsample, np.full(nsample, 1.0 / nsample), size=nbootstrap
+            )
+            y[conformer] = counts @ geometry_spectra[indices] / nsample
+        return x, y
+
+    # TODO
+    def get_spectrum(self, x_min, x_max, x_units, y_units):
+        """Returns a non-broadened spectrum as a tuple of x and y Numpy arrays"""
+        n_points = int((x_max - x_min) / self.de)
+        x = np.arange(x_min, x_max, self.de)
+        y = np.zeros(n_points)
+        return x, y
+
+    def _get_energy_range(self):
+        """Energy range of the broadened spectrum in eV,
+        conversion to other units is handled later"""
+        # NOTE: We don't include zero to prevent
+        # division by zero when converting to wavelength
+        x_min = max(0.01, self.excitation_energies.min() - 2.0)
+        x_max = self.excitation_energies.max() + 2.0
+        return x_min, x_max
+
+    def get_max_wavelength(self):
+        """Longest wavelength in nm worth plotting, determined from
+        the lowest excitation energy. Spectrum converted to nm
+        is cut at this wavelength."""
+        e_min = self.excitation_energies.min()
+        if e_min <= 0.0:
+            return None
+        return WAVELENGTH_RANGE_FACTOR * get_energy_unit_factor("nm") / e_min
+
+    def get_gaussian_spectrum(
+        self,
+        sigma,
+        x_unit,
+        y_unit,
+        method="truncated",
+        cutoff=GAUSSIAN_CUTOFF,
+        grid_error=GRID_ERROR,
+        nonuniform_grid=False,
+        per_conformer=False,
+    ):
+        """Returns Gaussian broadened spectrum
+
+        method: "dense" evaluates each transition on the whole grid,
+        "truncated" only within cutoff * sigma around each transition,
+        "fft" convolves binned transitions with the kernel via FFT,
+        which is fastest for very large number of transitions.
+        grid_error: target relative error of linear interpolation
+        between grid points, determines the grid spacing.
+        nonuniform_grid: use coarser grid far from all transitions
+        per_conformer: return spectra of individual conformers
+        as an array of shape (nconformer, len(x)), see combine_conformer_spectra()"""
+        kernel, normalization_factor, spacing = _get_kernel_parameters(
+            "gaussian", sigma, grid_error
+        )
+        return self._get_broadened_spectrum(
+            kernel,
+            sigma,
+            normalization_factor,
+            x_unit,
+            method=method,
+            cutoff=cutoff * sigma,
+            spacing=spacing,
+            nonuniform_grid=nonuniform_grid,
+            per_conformer=per_conformer,
+        )
+
+    def get_lorentzian_spectrum(
+        self,
+        tau,
+        x_unit,
+        y_unit,
+        method="dense",
+        cutoff=LORENTZIAN_CUTOFF,
+        grid_error=GRID_ERROR,
+        nonuniform_grid=False,
+        per_conformer=False,
+    ):
+        """Returns Lorentzian broadened spectrum
+
+        Parameters are the same as for get_gaussian_spectrum(),
+        with cutoff in units of tau (FWHM).
+        Use lorentzian_truncation_error() to estimate the error
+        of the truncated Lorentzian tails."""
+        kernel, normalization_factor, spacing = _get_kernel_parameters(
+            "lorentzian", tau, grid_error
+        )
+        return self._get_broadened_spectrum(
+            kernel,
+            tau,
+            normalization_factor,
+            x_unit,
+            method=method,
+            cutoff=cutoff * tau,
+            spacing=spacing,
+            nonuniform_grid=nonuniform_grid,
+            per_conformer=per_conformer,
+        )
+
+    @staticmethod
+    def lorentzian_truncation_error(cutoff=LORENTZIAN_CUTOFF):
+        """Relative error in total intensity when Lorentzian
+        is truncated at cutoff (in units of its FWHM).
+
+        This is the fraction of the Lorentzian area
+        outside of the interval (-cutoff * FWHM, cutoff * FWHM),
+        i.e. an upper bound on the relative intensity missing from the spectrum."""
+        return 1.0 - 2.0 / np.pi * np.arctan(2.0 * cutoff)
+
+    def _get_broadened_spectrum(
+        self,
+        kernel,
+        width,
+        normalization_factor,
+        x_unit,
+        method,
+        cutoff,
+        spacing,
+        nonuniform_grid,
+        per_conformer=False,
+    ):
+        x = self._get_energy_grid(spacing, width, nonuniform_grid)
+
+        # Each transition is normalized by the number of geometries
+        # of its conformer. Unless we want individual conformer spectra,
+        # they are summed in one pass, weighted by conformer populations.
+        if per_conformer:
+            rows = self.conformer_indices
+            conformer_factors = 1.0 / np.maximum(self.nsample, 1)
+        else:
+            rows = None
+            conformer_factors = self.conformer_weights / np.maximum(self.nsample, 1)
+
+        # TODO: Support other intensity units
+        unit_factor = self.COEFF_NEW
+        intensities = (
+            normalization_factor
+            * unit_factor
+            * self.osc_strengths
+            * conformer_factors[self.conformer_indices]
+        )
+        broadening_args = {"rows": rows, "nrows": self.nconformer}
+        if method == "dense":
+            y = _broaden(
+                x,
+                self.excitation_energies,
+                intensities,
+                kernel,
+                width,
+                **broadening_args,
+            )
+        elif method == "truncated":
+            order = self._get_sort_order()
+            if rows is not None:
+                broadening_args["rows"] = rows[order]
+            y = _broaden_truncated(
+                x,
+                self._get_sorted_energies(),
+                intensities[order],
+                kernel,
+                width,
+                cutoff,
+                **broadening_args,
+            )
+        elif method == "fft":
+            y = _broaden_fft(
+                x,
+                self.excitation_energies,
+                intensities,
+                kernel,
+                width,
+                cutoff,
+                **broadening_args,
+            )
+        else:
+            raise ValueError(f"Invalid broadening method '{method}'")
+
+        return convert_energy_unit(
+            x, y, x_unit, max_wavelength=self.get_max_wavelength()
+        )
+
+    def _get_energy_grid(self, spacing, width, nonuniform=False):
+        """Returns energy grid in eV with a given maximum spacing.
+
+        The number of grid points is clamped to (MIN_GRID_SIZE, MAX_GRID_SIZE).
+        If nonuniform is True, only every NONUNIFORM_GRID_COARSENING-th
+        point is kept further than NONUNIFORM_GRID_CUTOFF * width
+        from all transitions, where the spectrum is smooth."""
+        x_min, x_max = self._get_energy_range()
+        n_points = int(np.ceil((x_max - x_min) / spacing)) + 1
+        n_points = min(max(n_points, MIN_GRID_SIZE), MAX_GRID_SIZE)
+        x = np.linspace(x_min, x_max, num=n_points)
+        if not nonuniform or len(self.excitation_energies) == 0:
+            return x
+
+        energies = self._get_sorted_energies()
+        # Distance of each grid point to the nearest transition
+        right = np.searchsorted(energies, x).clip(max=len(energies) - 1)
+        left = (right - 1).clip(min=0)
+        distance = np.minimum(np.abs(x - energies[left]), np.abs(x - energies[right]))
+        keep = distance < NONUNIFORM_GRID_CUTOFF * width
+        keep[::NONUNIFORM_GRID_COARSENING] = True
+        keep[-1] = True
+        return x[keep]
+
+    def _get_sort_order(self):
+        """Returns indices that sort transitions by energy.
+        The sort is done only once."""
+        if self._sort_order is None:
+            self._sort_order = np.argsort(self.excitation_energies, kind="stable")
+        return self._sort_order
+
+    def _get_sorted_energies(self):
+        if self._sorted_energies is None:
+            self._sorted_energies = self.excitation_energies[self._get_sort_order()]
+        return self._sorted_energies
+
+
+class SpectrumAccumulator:
+    """Running sums of broadened spectra of individual conformers
+    on a fixed energy grid, for transitions that arrive incrementally,
+    e.g. from Wigner calculations that are still running.
+
+    Adding new transitions costs O(new transitions),
+    already added transitions are not broadened again.
+    Spectra are normalized by the number of distinct geometries
+    added so far, so they converge as more geometries arrive."""
+
+    def __init__(self, spectrum, kernel, width, grid_error=GRID_ERROR, method=None):
+        """spectrum: Spectrum with initial transitions, which determine the energy grid
+        kernel: "gaussian" or "lorentzian"
+        width: broadening width in eV
+        method: "dense", "truncated" or "fft", see Spectrum.get_gaussian_spectrum().
+        If None, it is chosen for each set of added transitions
+        based on their number, see _get_broadening_method()."""
+        self.kernel = kernel
+        self.width = width
+        self.method = method
+        self._kernel, normalization_factor, spacing = _get_kernel_parameters(
+            kernel, width, grid_error
+        )
+        # TODO: Support other intensity units
+        self._intensity_factor = normalization_factor * Spectrum.COEFF_NEW
+        # Kernels are truncated the same as in Spectrum.get_*_spectrum()
+        cutoff = GAUSSIAN_CUTOFF if kernel == "gaussian" else LORENTZIAN_CUTOFF
+        self._cutoff = cutoff * width
+        # Energy grid in eV
+        self.x = spectrum._get_energy_grid(spacing, width)
+        self._sums = np.zeros((spectrum.nconformer, len(self.x)))
+        self._nsample = np.zeros(spectrum.nconformer, dtype=int)
+        # Sorted keys of already added geometries,
+        # see TransitionSet._get_geometry_keys()
+        self._geometries = np.zeros(0, dtype=np.int64)
+        self.add(spectrum.transitions)
+
+    def add(self, transitions):
+        """Add new transitions to the spectrum.
+        Returns False if they do not fit on the energy grid,
+        in which case nothing is added and the spectrum
+        needs to be computed from scratch."""
+        if len(transitions) == 0:
+            return True
+        energies = transitions.energies
+        if energies.min() < self.x[0] or energies.max() > self.x[-1]:
+            return False
+
+        nconformer = int(transitions.conformer_indices.max()) + 1
+        if nconformer > len(self._nsample):
+            self._resize(nconformer)
+
+        intensities = self._intensity_factor * transitions.osc_strengths
+        rows = transitions.conformer_indices
+        nrows = len(self._nsample)
+        method = self.method or _get_broadening_method(self.kernel, len(transitions))
+        if method == "dense":
+            self._sums += _broaden(
+                self.x, energies, intensities, self._kernel, self.width, rows, nrows
+            )
+        elif method == "truncated":
+            order = np.argsort(energies, kind="stable")
+            self._sums += _broaden_truncated(
+                self.x,
+                energies[order],
+                intensities[order],
+                self._kernel,
+                self.width,
+                self._cutoff,
+                rows=rows[order],
+                nrows=nrows,
+            )
+        elif method == "fft":
+            self._sums += _broaden_fft(
+                self.x,
+                energies,
+                intensities,
+                self._kernel,
+                self.width,
+                self._cutoff,
+                rows=rows,
+                nrows=nrows,
+            )
+        else:
+            raise ValueError(f"Invalid broadening method '{method}'")
+
+        keys = np.unique(transitions._get_geometry_keys())
+        new_keys = np.setdiff1d(keys, self._geometries, assume_unique=True)
+        if len(new_keys) > 0:
+            self._geometries = np.union1d(self._geometries, new_keys)
+            conformers = new_keys >> 32
+            self._nsample += np.bincount(conformers, minlength=len(self._nsample))
+        return True
+
+    def copy(self):
+        """Returns an independent copy, which can be extended by add()
+        while the original is used elsewhere, e.g. in another thread"""
+        new = copy.copy(self)
+        new._sums = self._sums.copy()
+        new._nsample = self._nsample.copy()
+        # Geometry keys are not modified in place by add(), only replaced
+        return new
+
+    def get_conformer_spectra(self, nconformer=None):
+        """Returns spectra of individual conformers in eV
+        as an array of shape (nconformer, len(x)),
+        same as Spectrum.get_*_spectrum(per_conformer=True)"""
+        y = self._sums / np.maximum(self._nsample, 1)[:, np.newaxis]
+        if nconformer is not None and nconformer > len(y):
+            y = np.vstack([y, np.zeros((nconformer - len(y), len(self.x)))])
+        return y
+
+    def _resize(self, nconformer):
+        sums = np.zeros((nconformer, len(self.x)))
+        sums[: len(self._sums)] = self._sums
+        self._sums = sums
+        nsample = np.zeros(nconformer, dtype=int)
+        nsample[: len(self._nsample)] = self._nsample
+        self._nsample = nsample
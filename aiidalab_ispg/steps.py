@@ -6,6 +6,7 @@ Authors:
     * Carl Simon Adorf <simon.adorf@epfl.ch>
 """
 from pprint import pformat
+import time
 
 # DH: Hopefully we will be able to remove this
 from copy import deepcopy
@@ -15,7 +16,7 @@ import traitlets
 from traitlets import Union, Instance
 from aiida.common import NotExistent
 from aiida.engine import ProcessState, submit
-from aiida.orm import ProcessNode, load_code
+from aiida.orm import ProcessNode, QueryBuilder, load_code
 
 from aiida.orm import WorkChainNode
 from aiida.plugins import DataFactory
@@ -36,7 +37,8 @@ except ImportError:
     # TODO: Can we do something better than print here?
     print("ERROR: Could not find aiidalab_atmospec_workchain module!")
 
-from aiidalab_ispg.spectrum import SpectrumWidget
+from aiidalab_ispg.spectrum import SpectrumWidget, TransitionSet
+from aiidalab_ispg.batch_spectra import load_spectrum_data
 
 StructureData = DataFactory("structure")
 TrajectoryData = DataFactory("array.trajectory")
@@ -531,7 +533,15 @@ class ViewSpectrumStep(ipw.VBox, WizardAppWidgetStep):
 
     process = traitlets.Instance(ProcessNode, allow_none=True)
 
+    # Minimum interval in seconds between queries for newly finished
+    # Wigner calculations while the workflow is running
+    PARTIAL_SPECTRUM_INTERVAL = 10.0
+
     def __init__(self, **kwargs):
+        # PKs of Wigner calculations whose transitions are already plotted
+        self._streamed_calcs = set()
+        self._last_partial_update = None
+
         # Setup process monitor
         self.process_monitor = ProcessMonitor(
             timeout=0.1,
@@ -550,44 +560,41 @@ class ViewSpectrumStep(ipw.VBox, WizardAppWidgetStep):
         self.process = None
         self.spectrum.reset()
 
-    # TODO: Move this to the workflow
-    def _orca_output_to_transitions(self, output_dict, geom_index):
-        # TODO: Use atomic units both for energies and osc. strengths
-        CM2EV = 1 / 8065.547937
-        # TODO: Add error handling
-        en = output_dict["etenergies"]
-        osc = output_dict["etoscs"]
-        assert len(en) == len(osc)
-        # TODO: Use atomic units both for energies and osc. strengths
-        return [
-            {"energy": tr[0] * CM2EV, "osc_strength": tr[1], "geom_index": geom_index}
-            for tr in zip(en, osc)
-        ]
-
-    def _wigner_output_to_transitions(self, wigner_outputs):
-        nsample = len(wigner_outputs)
-        transitions = []
-        for i, params in zip(range(nsample), wigner_outputs):
-            transitions += self._orca_output_to_transitions(params, i)
-        return transitions
-
     def _show_spectrum(self):
 
+        if self.process is None:
+            return
+        if self.process.process_state in (
+            ProcessState.CREATED,
+            ProcessState.RUNNING,
+            ProcessState.WAITING,
+        ):
+            self._show_partial_spectrum()
+            return
         # TODO: Return if process is not finished_ok
-        if self.process is None or self.process.process_state != ProcessState.FINISHED:
+        if self.process.process_state != ProcessState.FINISHED:
             return
 
         # TODO: Handle different kind of computed spectra simultaneously.
         # This is a single-point spectrum
         # output_params = self.process.outputs.single_point_tddft.get_dict()
-        # transitions = self._orca_output_to_transitions(output_params, 0)
+        # transitions = TransitionSet.from_orca_output(output_params)
 
-        # TODO: This is a hack for now until we do a proper Boltzmann weighting.
-        conformer_transitions = []
-        for conformer in self.process.outputs.spectrum_data.get_list():
-            conformer_transitions += self._wigner_output_to_transitions(conformer)
+        conformer_transitions = TransitionSet.from_spectrum_data(
+            load_spectrum_data(self.process.outputs.spectrum_data)
+        )
 
-        self.spectrum.transitions = conformer_transitions
+        # Conformer energies for Boltzmann weighting are stored
+        # with optimized structures. Older workflows do not have them.
+        conformer_energies = None
+        if "relaxed_structures" in self.process.outputs:
+            relaxed_structures = self.process.outputs.relaxed_structures
+            if "energies" in relaxed_structures.get_arraynames():
+                conformer_energies = relaxed_structures.get_array("energies").tolist()
+
+        with self.spectrum.hold_trait_notifications():
+            self.spectrum.conformer_energies = conformer_energies
+            self.spectrum.transitions = conformer_transitions
         if "smiles" in self.process.inputs.structure.extras:
             self.spectrum.smiles = self.process.inputs.structure.extras["smiles"]
             # We're attaching smiles extra for the optimized structures as well
@@ -602,6 +609,115 @@ class ViewSpectrumStep(ipw.VBox, WizardAppWidgetStep):
             # spectrum before.
             self.spectrum.smiles = None
 
+    def _show_partial_spectrum(self):
+        """Add transitions from Wigner calculations that finished
+        since the last update, so that the spectrum progressively converges
+        while the workflow is still running. Only the new transitions
+        are broadened, see SpectrumWidget.add_transitions()"""
+        now = time.monotonic()
+        if (
+            self._last_partial_update is not None
+            and now - self._last_partial_update < self.PARTIAL_SPECTRUM_INTERVAL
+        ):
+            return
+        self._last_partial_update = now
+
+        new_calcs = {
+            pk: indices
+            for pk, indices in self._get_finished_wigner_calcs().items()
+            if pk not in self._streamed_calcs
+        }
+        if not new_calcs:
+            return
+
+        qb = QueryBuilder()
+        qb.append(
+            ProcessNode,
+            filters={"id": {"in": list(new_calcs)}},
+            project=["id"],
+            tag="wigner",
+        )
+        # Batched calculations return output_parameters_<geometry index>
+        qb.append(
+            Dict,
+            with_incoming="wigner",
+            edge_filters={"label": {"like": "output_parameters%"}},
+            edge_project=["label"],
+            edge_tag="link",
+            project=["attributes.etenergies", "attributes.etoscs"],
+            tag="params",
+        )
+        new_transitions = []
+        for row in qb.iterdict():
+            pk = row["wigner"]["id"]
+            label = row["link"]["label"]
+            params = row["params"]
+            conformer_index, geom_index = new_calcs[pk]
+            if label != "output_parameters":
+                geom_index = int(label.rpartition("_")[2])
+            new_transitions.append(
+                TransitionSet.from_orca_output(
+                    {
+                        "etenergies": params["attributes.etenergies"],
+                        "etoscs": params["attributes.etoscs"],
+                    },
+                    geom_index=geom_index,
+                    conformer_index=conformer_index,
+                )
+            )
+        self._streamed_calcs.update(new_calcs)
+        if new_transitions:
+            self.spectrum.add_transitions(TransitionSet.concatenate(new_transitions))
+
+    def _get_finished_wigner_calcs(self):
+        """Returns a dictionary {pk: (conformer_index, geom_index)}
+        of finished Wigner calculations of the current workflow.
+        Indices are given by the order in which the calculations were submitted.
+        Batched calculations (see OrcaBatchCalculation) contain several
+        geometries, their geom_index is None. They are included even if some
+        of the geometries failed, since the other ones are still valid."""
+
+        def query_conformers():
+            qb = QueryBuilder()
+            qb.append(WorkChainNode, filters={"id": self.process.pk}, tag="atmospec")
+            qb.append(
+                WorkChainNode,
+                with_incoming="atmospec",
+                filters={"attributes.process_label": "OrcaWignerSpectrumWorkChain"},
+                project=["id"],
+                tag="conformer",
+            )
+            return qb
+
+        # Conformers are ordered by PKs also when some of them
+        # have not yet submitted their Wigner calculations.
+        conformer_pks = sorted(pk for pk, in query_conformers().iterall())
+
+        qb = query_conformers()
+        # The labels are set in OrcaWignerSpectrumWorkChain
+        qb.append(
+            ProcessNode,
+            with_incoming="conformer",
+            filters={
+                "label": {"in": ["wigner-single-point-tddft", "wigner-batch-tddft"]}
+            },
+            project=["id", "label", "attributes.exit_status"],
+        )
+        wigner_calcs = {pk: [] for pk in conformer_pks}
+        for conformer_pk, pk, label, exit_status in qb.iterall():
+            wigner_calcs[conformer_pk].append((pk, label, exit_status))
+
+        finished = {}
+        for conformer_index, conformer_pk in enumerate(conformer_pks):
+            calcs = sorted(wigner_calcs[conformer_pk])
+            for geom_index, (pk, label, exit_status) in enumerate(calcs):
+                if label == "wigner-batch-tddft":
+                    if exit_status is not None:
+                        finished[pk] = (conformer_index, None)
+                elif exit_status == 0:
+                    finished[pk] = (conformer_index, geom_index)
+        return finished
+
     def _update_state(self):
         if self.process is None:
             self.state = self.State.INIT
@@ -622,4 +738,6 @@ class ViewSpectrumStep(ipw.VBox, WizardAppWidgetStep):
 
     @traitlets.observe("process")
     def _observe_process(self, change):
+        self._streamed_calcs = set()
+        self._last_partial_update = None
         self._update_state()
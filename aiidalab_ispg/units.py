@@ -0,0 +1,84 @@
+"""Energy unit conversions for UV/Vis spectra.
+
+Spectra are computed with energies in eV and converted to other units
+only for plotting. The same conversions are used for experimental spectra.
+
+Authors:
+    * Daniel Hollas <daniel.hollas@durham.ac.uk>
+"""
+import numpy as np
+from scipy import constants
+
+# TODO: Define energy units as Enum
+ENERGY_UNITS = ("eV", "nm", "cm^-1")
+
+# https://physics.nist.gov/cgi-bin/cuu/Info/Constants/basis.html
+# Photon wavelength in nm times its energy in eV, lambda = EV_NM / E
+EV_NM = constants.h * constants.c / constants.e * 1e9
+# https://physics.nist.gov/cgi-bin/cuu/Convert?exp=0&num=1&From=ev&To=minv&Action=Only+show+factor
+EV_TO_CM = constants.e / (constants.h * constants.c) / 100
+
+
+def get_energy_unit_factor(unit):
+    """Conversion factor from eV to a given energy unit.
+    For nm, this is the factor in lambda = factor / E"""
+    unit = unit.lower()
+    if unit == "ev":
+        return 1.0
+    elif unit == "nm":
+        return EV_NM
+    elif unit == "cm^-1":
+        return EV_TO_CM
+    raise ValueError(f"Unknown energy unit '{unit}'")
+
+
+def convert_energy_unit(
+    x, y, to_unit, from_unit="eV", jacobian=False, max_wavelength=None
+):
+    """Transform spectrum (x, y) with energies x in from_unit to to_unit.
+
+    Returns new arrays only when needed, i.e. input arrays
+    might be returned as they are and should not be modified afterwards.
+
+    jacobian: If True, y is a spectral density (e.g. per unit energy)
+    and is multiplied by |dE/dx| of the transformation. This is not needed
+    for cross sections, which have the same value in any energy unit.
+
+    max_wavelength: When converting to nm, points with longer wavelengths
+    are filtered out, as they would stretch the plot towards infinity.
+    Non-positive energies are always filtered out."""
+    if from_unit.lower() == to_unit.lower():
+        return x, y
+    if from_unit.lower() != "ev":
+        x, y = _convert_to_ev(x, y, from_unit, jacobian)
+    if to_unit.lower() == "ev":
+        return x, y
+
+    factor = get_energy_unit_factor(to_unit)
+    if to_unit.lower() != "nm":
+        if jacobian:
+            y = y / factor
+        return x * factor, y
+
+    mask = x > 0.0
+    if max_wavelength is not None:
+        mask &= x * max_wavelength >= factor
+    # Avoid copying all data when nothing is filtered out
+    if not mask.all():
+        x = x[mask]
+        # y might contain multiple spectra as rows
+        y = y[..., mask]
+    if jacobian:
+        # |dE/d(lambda)| = hc / lambda^2 = E^2 / hc
+        y = y * np.square(x) / factor
+    return np.divide(factor, x), y
+
+
+def _convert_to_ev(x, y, unit, jacobian):
+    factor = get_energy_unit_factor(unit)
+    if unit.lower() != "nm":
+        if jacobian:
+            y = y * factor
+        return x / factor, y
+    # Wavelength to energy is the same transformation as energy to wavelength
+    return convert_energy_unit(x, y, "nm", jacobian=jacobian)
@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def aiida_profile():
+    """Load the default AiiDA profile, tests that need the database
+    are skipped if there is none"""
+    aiida = pytest.importorskip("aiida")
+    from aiida.common.exceptions import ConfigurationError
+
+    try:
+        return aiida.load_profile()
+    except ConfigurationError as e:
+        pytest.skip(f"AiiDA profile is not configured: {e}")
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from aiidalab_ispg.batch_spectra import compute_spectra, read_spectra
+from aiidalab_ispg.spectrum_core import Spectrum, TransitionSet, boltzmann_weights
+
+
+def _spectrum_data(seed, nconformer=2, ngeom=5, nstate=3):
+    rng = np.random.default_rng(seed)
+    ntrans = nconformer * ngeom * nstate
+    return {
+        "energies": rng.uniform(3.0, 7.0, ntrans),
+        "osc_strengths": rng.uniform(0.0, 0.5, ntrans),
+        "geom_indices": np.tile(np.repeat(np.arange(ngeom), nstate), nconformer),
+        "conformer_indices": np.repeat(np.arange(nconformer), ngeom * nstate),
+        "state_indices": np.tile(np.arange(nstate), nconformer * ngeom),
+    }
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_compute_spectra_round_trip(tmp_path, max_workers):
+    records = [
+        (10, "CCO", _spectrum_data(0), np.array([0.0, 0.02])),
+        (3, None, _spectrum_data(1), None),
+        (7, "C=O", _spectrum_data(2), None),
+    ]
+    spectra = compute_spectra(
+        records, width=0.2, energy_unit="eV", temperature=300.0, max_workers=max_workers
+    )
+    filename = tmp_path / "spectra.npz"
+    np.savez_compressed(filename, **spectra)
+    result = read_spectra(filename)
+
+    assert sorted(result) == [3, 7, 10]
+    for pk, smiles, data, energies in records:
+        weights = None if energies is None else boltzmann_weights(energies, 300.0)
+        spectrum = Spectrum(
+            TransitionSet.from_spectrum_data(data), conformer_weights=weights
+        )
+        x, y = spectrum.get_gaussian_spectrum(0.2, "eV", "")
+        read_smiles, read_x, read_y = result[pk]
+        assert read_smiles == (smiles or "")
+        np.testing.assert_allclose(read_x, x)
+        np.testing.assert_allclose(read_y, y)
+
+
+def test_compute_spectra_empty(tmp_path):
+    spectra = compute_spectra([], max_workers=1)
+    filename = tmp_path / "spectra.npz"
+    np.savez_compressed(filename, **spectra)
+    assert read_spectra(filename) == {}
+
+
+def test_compute_spectra_boltzmann_weights(tmp_path):
+    data = _spectrum_data(0)
+    records = [
+        (1, "CCO", data, np.array([0.0, 0.1])),
+        (2, "CCO", data, None),
+    ]
+    spectra = compute_spectra(records, energy_unit="eV", max_workers=1)
+    filename = tmp_path / "spectra.npz"
+    np.savez_compressed(filename, **spectra)
+    result = read_spectra(filename)
+    # The second conformer is higher in energy by ~4 kT
+    # so it contributes much less than with equal weights
+    weighted, equal = result[1][2], result[2][2]
+    assert np.abs(weighted - equal).max() > 0.1 * equal.max()
+
+
+def _finished_workchain(smiles, spectrum_data):
+    """Stored node of a finished AtmospecWorkChain with its input structure
+    and spectrum_data output"""
+    from aiida.common import LinkType
+    from aiida.orm import ArrayData, StructureData, WorkChainNode
+    from aiidalab_atmospec_workchain import AtmospecWorkChain
+
+    structure = StructureData(cell=np.eye(3) * 10.0)
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols="C")
+    structure.base.extras.set("smiles", smiles)
+    structure.store()
+
+    node = WorkChainNode(process_type=AtmospecWorkChain.build_process_type())
+    node.base.links.add_incoming(structure, LinkType.INPUT_WORK, "structure")
+    node.set_exit_status(0)
+    node.store()
+
+    output = ArrayData()
+    for name, array in spectrum_data.items():
+        output.set_array(name, array)
+    output.store()
+    output.base.links.add_incoming(node, LinkType.RETURN, "spectrum_data")
+    return node
+
+
+def test_query_spectrum_data(aiida_profile):
+    from aiida.orm import Group
+
+    from aiidalab_ispg.batch_spectra import query_spectrum_data
+
+    nodes = [_finished_workchain("C", _spectrum_data(seed)) for seed in range(3)]
+    pks = [node.pk for node in nodes]
+    group = Group(label=f"test-batch-spectra-{pks[0]}").store()
+    group.add_nodes(nodes[1:])
+
+    def query_pks(**kwargs):
+        return [pk for pk, _, _, _ in query_spectrum_data(**kwargs)]
+
+    assert query_pks(pks=pks[:1]) == pks[:1]
+    assert query_pks(group=group.label) == pks[1:]
+    # Workchains given by PKs and by group are combined
+    assert query_pks(pks=pks[:2], group=group.label) == pks
+    assert query_pks(group="nonexistent-group") == []
+
+    pk, smiles, spectrum_data, conformer_energies = next(
+        query_spectrum_data(pks=pks[:1])
+    )
+    assert smiles == "C"
+    assert conformer_energies is None
+    for name, array in _spectrum_data(0).items():
+        np.testing.assert_array_equal(spectrum_data[name], array)
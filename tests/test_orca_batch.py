@@ -0,0 +1,140 @@
+import datetime
+
+import pytest
+
+ccio = pytest.importorskip("aiida_orca.parsers.cclib.ccio")
+
+from aiida.common import LinkType  # noqa: E402
+from aiida.orm import CalcJobNode, FolderData, StructureData  # noqa: E402
+from aiidalab_atmospec_workchain.orca_batch import (  # noqa: E402
+    OrcaBatchCalculation,
+    OrcaBatchParser,
+)
+
+# Minimal ORCA TDDFT output that cclib can parse
+ORCA_OUTPUT = """\
+                                 * O   R   C   A *
+                 Program Version 5.0.3 -  RELEASE  -
+
+---------------------------------
+CARTESIAN COORDINATES (ANGSTROEM)
+---------------------------------
+  C        0.000000       0.000000       0.000000
+
+-------------------------   --------------------
+FINAL SINGLE POINT ENERGY       -40.123456789
+-------------------------   --------------------
+
+-----------------------------------------------------------------------------
+         ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS
+-----------------------------------------------------------------------------
+State   Energy    Wavelength  fosc         T2        TX        TY        TZ
+        (cm-1)      (nm)                 (au**2)    (au)      (au)      (au)
+-----------------------------------------------------------------------------
+   1   45000.0     222.2   0.010000000   0.00000   0.00000   0.00000   0.00000
+   2   50000.0     200.0   0.020000000   0.00000   0.00000   0.00000   0.00000
+
+"""
+ORCA_SUCCESS = "TOTAL RUN TIME: 0 days 0 hours 0 minutes 1 seconds 0 msec\n"
+
+
+def _structure():
+    structure = StructureData(
+        cell=[[10.0, 0.0, 0.0], [0.0, 10.0, 0.0], [0.0, 0.0, 10.0]]
+    )
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols="C")
+    return structure.store()
+
+
+def _parse(indices, outputs):
+    """Parse retrieved ORCA outputs of a batch with given structure indices"""
+    process_cls = OrcaBatchCalculation
+    node = CalcJobNode(process_type=f"{process_cls.__module__}.{process_cls.__name__}")
+    for i in indices:
+        node.base.links.add_incoming(
+            _structure(), LinkType.INPUT_CALC, f"structures__structure_{i}"
+        )
+    node.store()
+    retrieved = FolderData()
+    for i, text in outputs.items():
+        retrieved.put_object_from_bytes(
+            text.encode(), process_cls._OUTPUT_FILE.format(i)
+        )
+    retrieved.base.links.add_incoming(node, LinkType.CREATE, "retrieved")
+    retrieved.store()
+
+    parser = OrcaBatchParser(node)
+    exit_code = parser.parse()
+    return exit_code, parser.outputs
+
+
+def test_render_input():
+    params = {
+        "charge": 0,
+        "multiplicity": 1,
+        "input_keywords": ["wB97X-D4", "def2-SVP"],
+        "extra_input_keywords": ["MiniPrint"],
+        "input_blocks": {"tddft": {"nroots": 3, "tda": "false"}, "scf": {}},
+    }
+    text = OrcaBatchCalculation._render_input(params, "aiida_3.coords.xyz")
+    assert text == (
+        "! wB97X-D4 def2-SVP\n"
+        "! MiniPrint\n"
+        "%tddft\n"
+        "\tnroots 3\n"
+        "\ttda false\n"
+        "end\n"
+        "%scf\n"
+        "end\n"
+        "* xyzfile 0 1 aiida_3.coords.xyz\n"
+    )
+    text = OrcaBatchCalculation._render_input(
+        {"charge": -1, "multiplicity": 2}, "a.xyz"
+    )
+    assert text == "! SP\n* xyzfile -1 2 a.xyz\n"
+
+
+def test_get_indices():
+    labels = ["structure_10", "structure_2", "structure_1"]
+    assert OrcaBatchCalculation.get_indices(labels) == [1, 2, 10]
+
+
+def test_parser(aiida_profile, monkeypatch):
+    ccread = ccio.ccread
+
+    def ccread_with_timings(handle):
+        # Only some cclib versions parse timings, as timedelta
+        data = ccread(handle)
+        data.metadata["wall_time"] = [datetime.timedelta(minutes=1, seconds=2.5)]
+        return data
+
+    monkeypatch.setattr(ccio, "ccread", ccread_with_timings)
+    output = ORCA_OUTPUT + ORCA_SUCCESS
+    exit_code, outputs = _parse([3, 4], {3: output, 4: output})
+    assert exit_code.status == 0
+    assert sorted(outputs) == ["output_parameters_3", "output_parameters_4"]
+    params = outputs["output_parameters_3"].get_dict()
+    assert params["metadata"]["success"]
+    # Timings are converted to seconds so that they can be stored
+    assert params["metadata"]["wall_time"] == [62.5]
+    assert params["etenergies"] == pytest.approx([45000.0, 50000.0])
+    assert params["etoscs"] == pytest.approx([0.01, 0.02])
+
+
+def test_parser_partial_failure(aiida_profile):
+    """Successful geometries are returned even if others failed"""
+    exit_code, outputs = _parse(
+        [0, 1, 2], {0: ORCA_OUTPUT + ORCA_SUCCESS, 1: ORCA_OUTPUT}
+    )
+    assert (
+        exit_code.status
+        == OrcaBatchCalculation.exit_codes.ERROR_OUTPUT_STDOUT_MISSING.status
+    )
+    assert list(outputs) == ["output_parameters_0"]
+
+    exit_code, outputs = _parse([0, 1], {0: ORCA_OUTPUT, 1: ORCA_OUTPUT + ORCA_SUCCESS})
+    assert (
+        exit_code.status
+        == OrcaBatchCalculation.exit_codes.ERROR_CALCULATION_UNSUCCESSFUL.status
+    )
+    assert list(outputs) == ["output_parameters_1"]
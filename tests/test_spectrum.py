@@ -0,0 +1,417 @@
+import numpy as np
+import pytest
+from scipy import constants
+
+from aiidalab_ispg import spectrum_core
+from aiidalab_ispg.spectrum_core import (
+    Spectrum,
+    SpectrumAccumulator,
+    TransitionSet,
+    boltzmann_weights,
+)
+from aiidalab_ispg.units import EV_NM, EV_TO_CM
+
+
+def _transitions(seed, nconformer=2, ngeom=(4, 7), nstate=3):
+    """Random transitions, conformers with different number of geometries"""
+    rng = np.random.default_rng(seed)
+    sets = [
+        TransitionSet(
+            energies=rng.uniform(3.0, 7.0, n * nstate),
+            osc_strengths=rng.uniform(0.0, 0.5, n * nstate),
+            geom_indices=np.repeat(np.arange(n), nstate),
+            conformer_indices=conformer,
+            state_indices=np.tile(np.arange(nstate), n),
+        )
+        for conformer, n in zip(range(nconformer), ngeom)
+    ]
+    return TransitionSet.concatenate(sets)
+
+
+def _reference_spectrum(x, spectrum, kernel, width):
+    """Broadened spectrum summed transition by transition"""
+    y = np.zeros_like(x)
+    for energy, osc, conformer in zip(
+        spectrum.excitation_energies,
+        spectrum.osc_strengths,
+        spectrum.conformer_indices,
+    ):
+        delta = x - energy
+        if kernel == "gaussian":
+            line = np.exp(-(delta**2) / 2 / width**2) / np.sqrt(2 * np.pi) / width
+        else:
+            line = width / 2 / np.pi / (delta**2 + width**2 / 4)
+        weight = spectrum.conformer_weights[conformer] / spectrum.nsample[conformer]
+        y += Spectrum.COEFF_NEW * osc * weight * line
+    return y
+
+
+def _broadened_spectrum(spectrum, kernel, width, **kwargs):
+    if kernel == "gaussian":
+        return spectrum.get_gaussian_spectrum(width, "eV", "", **kwargs)
+    return spectrum.get_lorentzian_spectrum(width, "eV", "", **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kernel, method, tolerance",
+    [
+        ("gaussian", "dense", 1e-10),
+        ("gaussian", "truncated", 1e-6),
+        ("gaussian", "fft", 1e-3),
+        ("lorentzian", "dense", 1e-10),
+        ("lorentzian", "truncated", 1e-2),
+        ("lorentzian", "fft", 5e-3),
+    ],
+)
+def test_broadening_methods(kernel, method, tolerance):
+    spectrum = Spectrum(_transitions(0), conformer_weights=[0.3, 0.7])
+    x, y = _broadened_spectrum(spectrum, kernel, 0.1, method=method)
+    reference = _reference_spectrum(x, spectrum, kernel, 0.1)
+    np.testing.assert_allclose(y, reference, rtol=0, atol=tolerance * reference.max())
+
+
+@pytest.mark.parametrize("method", ["dense", "truncated"])
+def test_broadening_in_blocks(monkeypatch, method):
+    """Transitions are broadened in blocks to limit memory usage"""
+    spectrum = Spectrum(_transitions(1), conformer_weights=[0.5, 0.5])
+    x, y = spectrum.get_gaussian_spectrum(0.1, "eV", "", method=method)
+    monkeypatch.setattr(spectrum_core, "BROADENING_BLOCK_SIZE", 1000)
+    x_blocks, y_blocks = spectrum.get_gaussian_spectrum(0.1, "eV", "", method=method)
+    np.testing.assert_array_equal(x_blocks, x)
+    np.testing.assert_allclose(y_blocks, y, rtol=1e-12)
+
+
+def test_truncated_broadening_window():
+    # Each kernel is evaluated only within the cutoff around its transition,
+    # transitions further than the cutoff from the grid do not contribute
+    x = np.linspace(3.0, 5.0, 201)
+    energies = np.array([1.0, 4.0, 8.0])
+    intensities = np.ones(3)
+    kernel, _, _ = spectrum_core._get_kernel_parameters("gaussian", 0.1)
+    y = spectrum_core._broaden_truncated(x, energies, intensities, kernel, 0.1, 0.3)
+    reference = np.where(np.abs(x - 4.0) <= 0.3, np.exp(-((x - 4.0) ** 2) / 0.02), 0.0)
+    np.testing.assert_allclose(y, reference, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize(
+    "kernel, ntransitions, method",
+    [
+        ("gaussian", 30, "truncated"),
+        ("gaussian", spectrum_core.FFT_MIN_TRANSITIONS, "fft"),
+        ("lorentzian", 30, "fft"),
+    ],
+)
+def test_accumulator_broadening_method(monkeypatch, kernel, ntransitions, method):
+    """SpectrumAccumulator, used by SpectrumWidget, broadens
+    large ensembles and Lorentzians via FFT"""
+    used = []
+    for name in ("truncated", "fft"):
+        function = getattr(spectrum_core, f"_broaden_{name}")
+
+        def spy(*args, _name=name, _function=function, **kwargs):
+            used.append(_name)
+            return _function(*args, **kwargs)
+
+        monkeypatch.setattr(spectrum_core, f"_broaden_{name}", spy)
+
+    nstate = 3
+    ngeom = (ntransitions // nstate + 1) // 2
+    spectrum = Spectrum(_transitions(3, ngeom=(ngeom, ngeom), nstate=nstate))
+    accumulator = SpectrumAccumulator(spectrum, kernel, 0.1)
+    assert used == [method]
+
+    y = spectrum.combine_conformer_spectra(accumulator.get_conformer_spectra())
+    reference = _reference_spectrum(accumulator.x, spectrum, kernel, 0.1)
+    np.testing.assert_allclose(y, reference, rtol=0, atol=5e-3 * reference.max())
+
+
+def test_transition_geometries():
+    rng = np.random.default_rng(4)
+    conformers = rng.integers(0, 3, 100)
+    geoms = rng.integers(-2, 10, 100)
+    transitions = TransitionSet(
+        rng.uniform(3.0, 7.0, 100),
+        rng.uniform(0.0, 0.5, 100),
+        geom_indices=geoms,
+        conformer_indices=conformers,
+    )
+    geometries, inverse = transitions.get_geometries(return_inverse=True)
+    pairs = np.stack([conformers, geoms], axis=1)
+    np.testing.assert_array_equal(geometries, np.unique(pairs, axis=0))
+    np.testing.assert_array_equal(geometries[inverse], pairs)
+    assert TransitionSet([], []).get_geometries().shape == (0, 2)
+
+
+def test_transitions_from_spectrum_data():
+    transitions = _transitions(2)
+    spectrum_data = {name: getattr(transitions, name) for name in TransitionSet.COLUMNS}
+    from_arrays = TransitionSet.from_spectrum_data(spectrum_data)
+
+    # Legacy format: list of ORCA outputs of Wigner geometries for each conformer
+    legacy = []
+    for conformer in range(2):
+        outputs = []
+        for geom in range(int(transitions.geom_indices.max()) + 1):
+            mask = (transitions.conformer_indices == conformer) & (
+                transitions.geom_indices == geom
+            )
+            if not mask.any():
+                break
+            outputs.append(
+                {
+                    "etenergies": list(transitions.energies[mask] * EV_TO_CM),
+                    "etoscs": list(transitions.osc_strengths[mask]),
+                }
+            )
+        legacy.append(outputs)
+    from_list = TransitionSet.from_spectrum_data(legacy)
+
+    for result in (from_arrays, from_list):
+        assert len(result) == len(transitions)
+        for name in TransitionSet.COLUMNS:
+            np.testing.assert_allclose(
+                getattr(result, name), getattr(transitions, name)
+            )
+    np.testing.assert_array_equal(
+        from_list.get_geometries(), transitions.get_geometries()
+    )
+
+
+def test_energy_grid():
+    spectrum = Spectrum(TransitionSet([3.0, 8.0], [0.1, 0.2]))
+    x = spectrum._get_energy_grid(spacing=0.01, width=0.1)
+    assert x[0] == pytest.approx(1.0) and x[-1] == pytest.approx(10.0)
+    assert np.diff(x).max() <= 0.01 + 1e-12
+    # Number of grid points is clamped
+    x = spectrum._get_energy_grid(spacing=1.0, width=0.1)
+    assert len(x) == spectrum_core.MIN_GRID_SIZE
+    x = spectrum._get_energy_grid(spacing=1e-5, width=0.1)
+    assert len(x) == spectrum_core.MAX_GRID_SIZE
+
+
+def test_nonuniform_energy_grid():
+    spectrum = Spectrum(TransitionSet([3.0, 8.0], [0.1, 0.2]))
+    uniform = spectrum._get_energy_grid(spacing=0.01, width=0.1)
+    x = spectrum._get_energy_grid(spacing=0.01, width=0.1, nonuniform=True)
+    # Far from transitions, only every n-th point is kept
+    assert len(x) < len(uniform) / 2
+    assert np.all(np.isin(x, uniform))
+    assert x[0] == uniform[0] and x[-1] == uniform[-1]
+    cutoff = spectrum_core.NONUNIFORM_GRID_CUTOFF * 0.1
+    near = uniform[(np.abs(uniform - 3.0) < cutoff) | (np.abs(uniform - 8.0) < cutoff)]
+    assert np.all(np.isin(near, x))
+    assert np.diff(x).max() <= spectrum_core.NONUNIFORM_GRID_COARSENING * 0.01 + 1e-12
+
+    # The spectrum is smooth where the grid is coarse
+    x_coarse, y_coarse = spectrum.get_gaussian_spectrum(
+        0.1, "eV", "", nonuniform_grid=True
+    )
+    x_fine, y_fine = spectrum.get_gaussian_spectrum(0.1, "eV", "")
+    np.testing.assert_allclose(
+        np.interp(x_fine, x_coarse, y_coarse),
+        y_fine,
+        rtol=0,
+        atol=spectrum_core.GRID_ERROR * y_fine.max(),
+    )
+
+
+def test_max_wavelength():
+    spectrum = Spectrum(TransitionSet([4.0, 6.0], [0.1, 0.2]))
+    max_wavelength = spectrum.get_max_wavelength()
+    assert max_wavelength == pytest.approx(
+        spectrum_core.WAVELENGTH_RANGE_FACTOR * EV_NM / 4.0
+    )
+    x, y = spectrum.get_gaussian_spectrum(0.1, "nm", "")
+    assert x.max() <= max_wavelength * (1 + 1e-12)
+    assert x.min() == pytest.approx(EV_NM / 8.0)
+    assert Spectrum(TransitionSet([0.0, 6.0], [0.1, 0.2])).get_max_wavelength() is None
+
+
+@pytest.mark.parametrize("method", ["dense", "truncated", "fft"])
+def test_per_conformer_spectra(method):
+    spectrum = Spectrum(_transitions(1), conformer_weights=[0.2, 0.8])
+    x, y = spectrum.get_gaussian_spectrum(0.2, "eV", "", method=method)
+    x_conf, y_conf = spectrum.get_gaussian_spectrum(
+        0.2, "eV", "", method=method, per_conformer=True
+    )
+    assert y_conf.shape == (2, len(x))
+    np.testing.assert_array_equal(x_conf, x)
+    np.testing.assert_allclose(
+        spectrum.combine_conformer_spectra(y_conf), y, rtol=0, atol=1e-12 * y.max()
+    )
+
+
+def test_boltzmann_weights():
+    kt = constants.k * 300.0 / constants.e
+    weights = boltzmann_weights([0.1, 0.1 + kt, 0.1], 300.0)
+    np.testing.assert_allclose(
+        weights, np.array([1.0, np.exp(-1.0), 1.0]) / (2 + np.exp(-1.0))
+    )
+    with pytest.raises(ValueError):
+        boltzmann_weights([0.0, 0.1], 0.0)
+
+
+def test_conformer_weights():
+    transitions = _transitions(5)
+    spectrum = Spectrum(transitions, conformer_weights=[1.0, 3.0])
+    np.testing.assert_allclose(spectrum.conformer_weights, [0.25, 0.75])
+    with pytest.raises(ValueError):
+        Spectrum(transitions, conformer_weights=[1.0])
+    with pytest.raises(ValueError):
+        Spectrum(transitions, conformer_weights=[1.0, -1.0])
+
+
+@pytest.mark.parametrize(
+    "broaden, args",
+    [
+        (spectrum_core._broaden, ()),
+        (spectrum_core._broaden_truncated, (0.5,)),
+    ],
+)
+def test_broadening_into_rows(monkeypatch, broaden, args):
+    """Transitions are summed into separate spectra, e.g. of each geometry"""
+    monkeypatch.setattr(spectrum_core, "BROADENING_BLOCK_SIZE", 1000)
+    rng = np.random.default_rng(3)
+    x = np.linspace(2.0, 8.0, 101)
+    energies = np.sort(rng.uniform(3.0, 7.0, 60))
+    intensities = rng.uniform(0.0, 1.0, 60)
+    rows = rng.integers(0, 5, 60)
+    kernel = spectrum_core._gaussian_kernel
+    y = broaden(x, energies, intensities, kernel, 0.1, *args, rows=rows, nrows=6)
+    assert y.shape == (6, len(x))
+    for row in range(6):
+        mask = rows == row
+        reference = broaden(x, energies[mask], intensities[mask], kernel, 0.1, *args)
+        np.testing.assert_allclose(y[row], reference, rtol=0, atol=1e-12)
+
+
+def _identical_geometries(ngeom, nstate=3):
+    """Transitions of a single conformer, all geometries are the same"""
+    rng = np.random.default_rng(7)
+    return TransitionSet(
+        energies=np.tile(rng.uniform(3.0, 7.0, nstate), ngeom),
+        osc_strengths=np.tile(rng.uniform(0.0, 0.5, nstate), ngeom),
+        geom_indices=np.repeat(np.arange(ngeom), nstate),
+        state_indices=np.tile(np.arange(nstate), ngeom),
+    )
+
+
+def test_bootstrap_spectra():
+    spectrum = Spectrum(_transitions(5), conformer_weights=[0.4, 0.6])
+    x, y = spectrum.get_bootstrap_spectra("gaussian", 0.2, nbootstrap=50)
+    assert y.shape == (2, 50, len(x))
+    x_conf, y_conf = spectrum.get_gaussian_spectrum(
+        0.2, "eV", "", method="truncated", per_conformer=True
+    )
+    np.testing.assert_array_equal(x, x_conf)
+    # Resampled spectra scatter around the spectrum of each conformer
+    assert np.abs(y - y_conf[:, np.newaxis]).max() > 0.01 * y_conf.max()
+    np.testing.assert_allclose(y.mean(axis=1), y_conf, rtol=0, atol=0.3 * y_conf.max())
+    # Resamples are reproducible
+    _, y_again = spectrum.get_bootstrap_spectra("gaussian", 0.2, nbootstrap=50)
+    np.testing.assert_array_equal(y_again, y)
+
+    spectrum = Spectrum(_identical_geometries(4))
+    x, y = spectrum.get_bootstrap_spectra("lorentzian", 0.2, nbootstrap=10)
+    _, y_conf = spectrum.get_lorentzian_spectrum(
+        0.2, "eV", "", method="truncated", per_conformer=True
+    )
+    np.testing.assert_allclose(y[0], np.tile(y_conf[0], (10, 1)), rtol=1e-12)
+
+
+def test_bootstrap_confidence_band():
+    spectrum = Spectrum(_transitions(5), conformer_weights=[0.4, 0.6])
+    _, y = spectrum.get_bootstrap_spectra("gaussian", 0.2)
+    y = spectrum.combine_conformer_spectra(y)
+    lower, upper, error = spectrum_core.bootstrap_confidence_band(y)
+    mean = y.mean(axis=0)
+    assert np.all(lower <= mean) and np.all(mean <= upper)
+    assert np.any(lower < upper)
+    assert 0.0 < error < 1.0
+
+    spectrum = Spectrum(_identical_geometries(4))
+    _, y = spectrum.get_bootstrap_spectra("gaussian", 0.2)
+    lower, upper, error = spectrum_core.bootstrap_confidence_band(y[0])
+    np.testing.assert_allclose(upper - lower, 0.0, atol=1e-12 * upper.max())
+    assert error == pytest.approx(0.0, abs=1e-12)
+
+
+def test_sampling_error_needs_two_geometries():
+    assert Spectrum(_transitions(5, ngeom=(2, 7))).can_estimate_sampling_error()
+    transitions = _transitions(5, ngeom=(1, 7))
+    assert not Spectrum(transitions).can_estimate_sampling_error()
+    # Conformers that do not contribute do not matter
+    spectrum = Spectrum(transitions, conformer_weights=[0.0, 1.0])
+    assert spectrum.can_estimate_sampling_error()
+    assert not Spectrum(_identical_geometries(1)).can_estimate_sampling_error()
+
+
+def _select(transitions, mask):
+    return TransitionSet(
+        *(getattr(transitions, name)[mask] for name in TransitionSet.COLUMNS)
+    )
+
+
+@pytest.mark.parametrize("kernel", ["gaussian", "lorentzian"])
+def test_accumulator_add(kernel):
+    transitions = _transitions(6, ngeom=(4, 6))
+    first = transitions.geom_indices < 2
+    accumulator = SpectrumAccumulator(
+        Spectrum(_select(transitions, first)), kernel, 0.2
+    )
+    # Transitions within the energy range of the initial ones
+    rest = ~first & (transitions.energies > accumulator.x[0])
+    rest &= transitions.energies < accumulator.x[-1]
+    assert accumulator.add(_select(transitions, rest))
+
+    # Incremental result is the same as if computed at once
+    spectrum = Spectrum(_select(transitions, first | rest))
+    np.testing.assert_array_equal(accumulator._nsample, spectrum.nsample)
+    y = spectrum.combine_conformer_spectra(accumulator.get_conformer_spectra())
+    reference = _reference_spectrum(accumulator.x, spectrum, kernel, 0.2)
+    np.testing.assert_allclose(y, reference, rtol=0, atol=5e-3 * reference.max())
+
+
+def test_accumulator_add_outside_of_grid():
+    accumulator = SpectrumAccumulator(Spectrum(_transitions(7)), "gaussian", 0.1)
+    sums = accumulator._sums.copy()
+    nsample = accumulator._nsample.copy()
+    outside = TransitionSet([4.0, 100.0], [0.1, 0.1], geom_indices=99)
+    assert not accumulator.add(outside)
+    np.testing.assert_array_equal(accumulator._sums, sums)
+    np.testing.assert_array_equal(accumulator._nsample, nsample)
+
+
+def test_accumulator_geometries():
+    accumulator = SpectrumAccumulator(Spectrum(_transitions(8)), "gaussian", 0.1)
+    np.testing.assert_array_equal(accumulator._nsample, [4, 7])
+    # Another state of an already added geometry
+    assert accumulator.add(TransitionSet([4.0], [0.1], geom_indices=0))
+    np.testing.assert_array_equal(accumulator._nsample, [4, 7])
+    # New geometry of a new conformer
+    assert accumulator.add(
+        TransitionSet([4.0], [0.1], geom_indices=0, conformer_indices=2)
+    )
+    np.testing.assert_array_equal(accumulator._nsample, [4, 7, 1])
+    assert accumulator.get_conformer_spectra().shape == (3, len(accumulator.x))
+    assert accumulator.get_conformer_spectra(4).shape == (4, len(accumulator.x))
+
+
+def test_accumulator_copy():
+    accumulator = SpectrumAccumulator(Spectrum(_transitions(9)), "gaussian", 0.1)
+    y = accumulator.get_conformer_spectra()
+    new = accumulator.copy()
+    assert new.add(TransitionSet([4.0], [0.1], geom_indices=10))
+    np.testing.assert_array_equal(accumulator.get_conformer_spectra(), y)
+    np.testing.assert_array_equal(accumulator._nsample, [4, 7])
+    np.testing.assert_array_equal(new._nsample, [5, 7])
+
+
+def test_conformers_without_geometries():
+    # Conformers without any geometries yet do not scale down the spectrum
+    transitions = _transitions(10, nconformer=1, ngeom=(5,))
+    spectrum = Spectrum(transitions, conformer_weights=[0.5, 0.5])
+    np.testing.assert_allclose(spectrum.conformer_weights, [1.0, 0.0])
+    x, y = spectrum.get_gaussian_spectrum(0.1, "eV", "")
+    x_ref, y_ref = Spectrum(transitions).get_gaussian_spectrum(0.1, "eV", "")
+    np.testing.assert_allclose(y, y_ref)
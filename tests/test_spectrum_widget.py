@@ -0,0 +1,151 @@
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+pytest.importorskip("aiida")
+pytest.importorskip("bokeh")
+
+from aiidalab_ispg.spectrum import (  # noqa: E402
+    ExperimentalSpectrumCache,
+    SpectrumWidget,
+)
+from aiidalab_ispg.spectrum_core import Spectrum, TransitionSet  # noqa: E402
+from aiidalab_ispg.units import EV_NM  # noqa: E402
+
+
+def _transitions(rng, geom_indices, nstate=3):
+    ngeom = len(geom_indices)
+    return TransitionSet(
+        rng.uniform(4.0, 6.0, ngeom * nstate),
+        rng.uniform(0.0, 0.1, ngeom * nstate),
+        geom_indices=np.repeat(geom_indices, nstate),
+    )
+
+
+def _wait_for(condition, timeout=10.0):
+    start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - start < timeout, "Spectrum was not computed"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def widget():
+    widget = SpectrumWidget()
+    widget.RECOMPUTE_DELAY = 0.0
+    yield widget
+    widget.close()
+
+
+def test_add_transitions(widget):
+    rng = np.random.default_rng(0)
+    widget.transitions = _transitions(rng, np.arange(5))
+    _wait_for(lambda: widget._theory_spectrum_ev is not None)
+
+    computed = []
+    compute_spectrum = widget._compute_spectrum
+
+    def spy(*args):
+        computed.append(args)
+        return compute_spectrum(*args)
+
+    widget._compute_spectrum = spy
+    for geom_index in range(5, 10):
+        widget.add_transitions(_transitions(rng, [geom_index]))
+    # New transitions were added to the cached spectrum
+    assert computed == []
+    assert len(widget.transitions) == 30
+
+    x, y = widget._theory_spectrum_ev
+    spectrum = Spectrum(widget.transitions)
+    assert spectrum.nsample[0] == 10
+    x_ref, y_ref = spectrum.get_gaussian_spectrum(widget.width_slider.value, "eV", "")
+    np.testing.assert_allclose(
+        np.interp(x_ref, x, y), y_ref, rtol=0, atol=1e-2 * y_ref.max()
+    )
+
+
+def test_add_transitions_outside_of_energy_range(widget):
+    rng = np.random.default_rng(1)
+    widget.transitions = _transitions(rng, np.arange(5))
+    _wait_for(lambda: widget._theory_spectrum_ev is not None)
+    x_old = widget._theory_spectrum_ev[0]
+
+    widget.add_transitions(TransitionSet([20.0], [0.1], geom_indices=5))
+    # Energy grid does not cover the new transition, spectrum is recomputed
+    _wait_for(lambda: widget._theory_spectrum_ev[0][-1] > x_old[-1])
+    assert widget._theory_spectrum_ev[0][-1] > 20.0
+
+
+def _confidence_band(widget):
+    figure = widget.figure.get_figure()
+    return figure.select_one({"name": widget.CONFIDENCE_BAND_LABEL})
+
+
+def test_sampling_error(widget):
+    rng = np.random.default_rng(2)
+    widget.confidence_band_checkbox.value = True
+    widget.transitions = _transitions(rng, np.arange(5))
+    _wait_for(lambda: widget._confidence_band_ev is not None)
+    _wait_for(lambda: _confidence_band(widget).visible)
+    assert "5 geometries" in widget.sampling_error_info.value
+
+    # A single geometry does not say anything about the sampling error
+    widget.transitions = _transitions(rng, [0])
+    _wait_for(lambda: "undefined" in widget.sampling_error_info.value)
+    assert widget._confidence_band_ev is None
+    assert not _confidence_band(widget).visible
+
+
+def test_close_stops_recompute_thread():
+    widget = SpectrumWidget()
+    widget.RECOMPUTE_DELAY = 0.0
+    widget.transitions = _transitions(np.random.default_rng(3), np.arange(5))
+    _wait_for(lambda: widget._theory_spectrum_ev is not None)
+    thread = widget._recompute_thread
+    assert thread.is_alive()
+
+    widget.close()
+    assert not thread.is_alive()
+    assert widget._recompute_thread is None
+    # Nothing is computed after the widget was closed
+    widget.width_slider.value = 0.5
+    assert widget._recompute_thread is None
+
+
+def _experimental_spectrum():
+    from aiida.orm import XyData
+
+    node = XyData()
+    node.set_x(np.linspace(200.0, 400.0, 11), "wavelength", "nm")
+    node.set_y(np.linspace(0.0, 1.0, 11), "cross_section", "cm^2")
+    return node.store()
+
+
+def test_experimental_spectrum_cache(aiida_profile):
+    cache = ExperimentalSpectrumCache()
+    cache.INDEX_REFRESH_INTERVAL = 0.0
+    # Unique identifiers instead of SMILES, so that other nodes do not match
+    smiles, other_smiles = f"test-{uuid.uuid4()}", f"test-{uuid.uuid4()}"
+    assert cache.find(smiles) is None
+
+    # Extra set only after the node was stored
+    node = _experimental_spectrum()
+    assert cache.find(smiles) is None
+    node.base.extras.set("smiles", smiles)
+    found_node, (energies, cross_section) = cache.find(smiles)
+    assert found_node.pk == node.pk
+    np.testing.assert_allclose(energies.max(), EV_NM / 200.0)
+
+    node.base.extras.set("smiles", other_smiles)
+    assert cache.find(smiles) is None
+    assert cache.find(other_smiles)[0].pk == node.pk
+
+    # First stored spectrum is returned
+    newer_node = _experimental_spectrum()
+    newer_node.base.extras.set("smiles", other_smiles)
+    assert cache.find(other_smiles)[0].pk == node.pk
+    node.base.extras.delete("smiles")
+    assert cache.find(other_smiles)[0].pk == newer_node.pk
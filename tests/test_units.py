@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy.integrate import trapezoid
+
+from aiidalab_ispg.units import EV_NM, EV_TO_CM, convert_energy_unit
+
+
+@pytest.mark.parametrize("unit, factor", [("nm", EV_NM), ("cm^-1", EV_TO_CM)])
+@pytest.mark.parametrize("jacobian", [False, True])
+def test_energy_unit_round_trip(unit, factor, jacobian):
+    x = np.linspace(1.0, 8.0, 50)
+    y = np.exp(-((x - 4.0) ** 2))
+    x_new, y_new = convert_energy_unit(x, y, unit, jacobian=jacobian)
+    if unit == "nm":
+        np.testing.assert_allclose(x_new, factor / x)
+    else:
+        np.testing.assert_allclose(x_new, factor * x)
+    if not jacobian:
+        np.testing.assert_array_equal(y_new, y)
+
+    x_back, y_back = convert_energy_unit(
+        x_new, y_new, "eV", from_unit=unit, jacobian=jacobian
+    )
+    np.testing.assert_allclose(x_back, x)
+    np.testing.assert_allclose(y_back, y)
+
+
+@pytest.mark.parametrize("unit", ["nm", "cm^-1"])
+def test_energy_unit_jacobian_preserves_integral(unit):
+    x = np.linspace(2.0, 6.0, 2001)
+    y = np.exp(-((x - 4.0) ** 2) / 0.1)
+    x_new, y_new = convert_energy_unit(x, y, unit, jacobian=True)
+    integral = np.abs(trapezoid(y_new, x_new))
+    assert integral == pytest.approx(trapezoid(y, x), rel=1e-4)
+
+
+def test_same_energy_unit():
+    x = np.linspace(1.0, 8.0, 50)
+    y = np.ones_like(x)
+    x_new, y_new = convert_energy_unit(x, y, "eV", jacobian=True)
+    assert x_new is x and y_new is y
+
+
+def test_wavelength_cutoff():
+    x = np.linspace(-1.0, 5.0, 61)
+    y = np.vstack([x, 2 * x])
+    max_wavelength = EV_NM / 2.0
+    wavelengths, y_new = convert_energy_unit(x, y, "nm", max_wavelength=max_wavelength)
+    # Non-positive energies and wavelengths longer than max_wavelength are removed
+    mask = x >= 2.0 - 1e-12
+    np.testing.assert_allclose(wavelengths, EV_NM / x[mask])
+    np.testing.assert_array_equal(y_new, y[:, mask])
+    assert wavelengths.max() <= max_wavelength * (1 + 1e-12)
+
+    # Without max_wavelength, only non-positive energies are removed
+    wavelengths, y_new = convert_energy_unit(x, y, "nm")
+    np.testing.assert_allclose(wavelengths, EV_NM / x[x > 0.0])
+    assert y_new.shape == (2, np.count_nonzero(x > 0.0))
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+# Importing the workchain package requires AiiDA
+wigner = pytest.importorskip("aiidalab_atmospec_workchain.wigner")
+
+
+@pytest.mark.parametrize("sampling", wigner.SAMPLING_METHODS)
+def test_wigner_sample_moments(sampling):
+    rng = np.random.default_rng(3)
+    natom = 3
+    nmode = 3 * natom - 6
+    sampler = wigner.Wigner(
+        atom_names=["O", "H", "H"],
+        masses=[16.0, 1.0, 1.0],
+        coordinates=rng.normal(size=(natom, 3)),
+        frequencies=[1600.0, 3700.0, 3800.0],
+        vibrations=rng.normal(size=(nmode, natom * 3)),
+        seed="test",
+        sampling=sampling,
+    )
+    # Displacements are linear in normal mode coordinates Q,
+    # each of which has zero mean and variance 1/2
+    modes = (sampler._displace(np.eye(nmode)) - sampler.coordinates).reshape(nmode, -1)
+    covariance = 0.5 * modes.T @ modes
+
+    nsample = 4096
+    samples = sampler.get_samples(nsample).reshape(nsample, -1)
+    assert samples.shape == (nsample, natom * 3)
+    stderr = np.sqrt(np.diag(covariance) / nsample)
+    np.testing.assert_array_less(
+        np.abs(samples.mean(axis=0) - sampler.coordinates.ravel()), 5 * stderr
+    )
+    sample_covariance = np.cov(samples, rowvar=False)
+    error = np.linalg.norm(sample_covariance - covariance) / np.linalg.norm(covariance)
+    assert error < 0.05
+
+
+def test_wigner_samples_are_reproducible():
+    kwargs = dict(
+        atom_names=["C", "O"],
+        masses=[12.0, 16.0],
+        coordinates=[[0.0, 0.0, 0.0], [0.0, 0.0, 2.1]],
+        frequencies=[2100.0],
+        vibrations=[[0.0, 0.0, -0.7, 0.0, 0.0, 0.5]],
+    )
+    samples = wigner.Wigner(seed="a", **kwargs).get_samples(10)
+    np.testing.assert_array_equal(
+        wigner.Wigner(seed="a", **kwargs).get_samples(10), samples
+    )
+    assert not np.allclose(wigner.Wigner(seed="b", **kwargs).get_samples(10), samples)
+
+
+def test_sobol_samples_are_more_uniform():
+    """Sobol sequence estimates the mean with a much smaller error"""
+    kwargs = dict(
+        atom_names=["C", "O"],
+        masses=[12.0, 16.0],
+        coordinates=[[0.0, 0.0, 0.0], [0.0, 0.0, 2.1]],
+        frequencies=[2100.0],
+        vibrations=[[0.0, 0.0, -0.7, 0.0, 0.0, 0.5]],
+    )
+    errors = {}
+    for sampling in ("random", "sobol"):
+        for seed in ("a", "b", "c"):
+            sampler = wigner.Wigner(seed=seed, sampling=sampling, **kwargs)
+            samples = sampler.get_samples(256)
+            error = np.abs(samples.mean(axis=0) - sampler.coordinates).max()
+            errors[sampling] = max(errors.get(sampling, 0.0), error)
+    assert errors["sobol"] < 0.5 * errors["random"]
+
+
+def test_unknown_sampling_method():
+    with pytest.raises(ValueError):
+        wigner.Wigner(
+            ["H", "H"],
+            [1.0, 1.0],
+            [[0, 0, 0], [0, 0, 1.4]],
+            [4400.0],
+            [[0, 0, 1, 0, 0, -1]],
+            "seed",
+            sampling="grid",
+        )
@@ -0,0 +1,57 @@
+import sys
+
+import numpy as np
+import pytest
+
+workchain = pytest.importorskip("aiidalab_atmospec_workchain")
+
+from aiidalab_ispg.units import EV_TO_CM  # noqa: E402
+
+
+def _output_parameters(rng, ngeom, nstate=3):
+    """ORCA output parameters of TDDFT calculations, energies in cm^-1"""
+    return [
+        {
+            "etenergies": rng.uniform(3.0, 7.0, nstate) * EV_TO_CM,
+            "etoscs": rng.uniform(0.0, 0.5, nstate),
+        }
+        for _ in range(ngeom)
+    ]
+
+
+def test_spectrum_change():
+    rng = np.random.default_rng(0)
+    old = _output_parameters(rng, 10)
+    assert workchain.get_spectrum_change(old, []) == 0.0
+    # Spectrum is averaged over geometries, so adding the same ones changes nothing
+    assert workchain.get_spectrum_change(old, old) == pytest.approx(0.0, abs=1e-12)
+
+    new = _output_parameters(rng, 10)
+    change = workchain.get_spectrum_change(old, new)
+    assert 0.0 < change < 1.0
+    # Relative norm of the change does not depend on the energy grid
+    all_parameters = old + new
+    x = np.linspace(2.0, 8.0, 1000)
+    y_old = workchain._broaden_spectrum(old, x, 0.1)
+    y_new = workchain._broaden_spectrum(all_parameters, x, 0.1)
+    expected = np.linalg.norm(y_new - y_old) / np.linalg.norm(y_new)
+    assert change == pytest.approx(expected, rel=1e-2)
+
+    # Spectrum converges with the number of geometries
+    many = _output_parameters(rng, 1000)
+    assert workchain.get_spectrum_change(many, new) < change
+
+
+def test_spectrum_change_without_transitions():
+    empty = [{"etenergies": np.zeros(0), "etoscs": np.zeros(0)}]
+    assert workchain.get_spectrum_change(empty, empty) == 0.0
+
+
+def test_free_slots(aiida_profile):
+    from aiida.orm import Int
+
+    assert workchain._get_free_slots(100, None) == sys.maxsize
+    assert workchain._get_free_slots(0, Int(4)) == 4
+    assert workchain._get_free_slots(3, Int(4)) == 1
+    # More processes might be running, e.g. after the limit was lowered
+    assert workchain._get_free_slots(6, Int(4)) == 0
@@ -1,129 +1,210 @@
 """Base work chain to run an ORCA calculation"""
 
-import ase
-from aiida.engine import WorkChain, calcfunction
-from aiida.engine import append_, ToContext, if_
+import sys
 
-# not sure if this is needed? Can we use self.run()?
-from aiida.engine import run
+import numpy as np
+from aiida.engine import WorkChain, calcfunction
+from aiida.engine import append_, ToContext, if_, while_
 from aiida.plugins import CalculationFactory, WorkflowFactory, DataFactory
 from aiida.orm import to_aiida_type
 
-from .wigner import Wigner
+from .orca_batch import OrcaBatchCalculation
+from .wigner import ANG_TO_BOHR, SAMPLING_METHODS, Wigner
 
 StructureData = DataFactory("structure")
 TrajectoryData = DataFactory("array.trajectory")
 Int = DataFactory("int")
+Float = DataFactory("float")
+Str = DataFactory("str")
 Bool = DataFactory("bool")
 Code = DataFactory("code")
-List = DataFactory("list")
 Dict = DataFactory("dict")
+ArrayData = DataFactory("array")
 
 OrcaCalculation = CalculationFactory("orca_main")
 OrcaBaseWorkChain = WorkflowFactory("orca.base")
 
+# Conversion factor from eV to cm^-1, used for ORCA excitation energies
+EV_TO_CM = 8065.543937
+# Gaussian broadening (in eV) of the spectrum used to check the convergence
+# of adaptive Wigner sampling, see OrcaWignerSpectrumWorkChain
+CONVERGENCE_BROADENING = 0.1
+
+# Names of arrays in the compact spectrum data (ArrayData),
+# they match the columns of aiidalab_ispg.spectrum_core.TransitionSet
+SPECTRUM_DATA_ARRAYS = (
+    "energies",
+    "osc_strengths",
+    "geom_indices",
+    "conformer_indices",
+    "state_indices",
+)
+
+
+def _get_orca_arrays(output_parameters, geom_index):
+    energies = np.asarray(output_parameters["etenergies"], dtype=float)
+    nstates = len(energies)
+    return {
+        "energies": energies / EV_TO_CM,
+        "osc_strengths": np.asarray(output_parameters["etoscs"], dtype=float),
+        "geom_indices": np.full(nstates, geom_index),
+        "conformer_indices": np.zeros(nstates, dtype=int),
+        "state_indices": np.arange(nstates),
+    }
+
+
+# NOTE: Data from child workflows are combined via calcfunctions,
+# which keep the provenance but, unlike a nested WorkChain launched
+# via run(), do not block the daemon worker in a nested event loop.
+@calcfunction
+def concat_spectrum_data(**kwargs):
+    """Combine excitations from several calculations
+    into a compact ArrayData, see SPECTRUM_DATA_ARRAYS.
+    Excitation energies are stored in eV.
+
+    Inputs are either ORCA output parameters (Dict) of Wigner geometries,
+    passed as output_parameters_<geometry index>,
+    or spectrum data (ArrayData) of conformers,
+    passed as spectrum_data_<conformer index>."""
+    arrays = {name: [] for name in SPECTRUM_DATA_ARRAYS}
+    # Link labels must be valid identifiers, so indices are only suffixes
+    indices = {int(key.rpartition("_")[2]): key for key in kwargs}
+    for index in sorted(indices):
+        node = kwargs[indices[index]]
+        if isinstance(node, Dict):
+            data = _get_orca_arrays(node, index)
+        else:
+            data = {name: node.get_array(name) for name in SPECTRUM_DATA_ARRAYS}
+            data["conformer_indices"] = np.full_like(data["conformer_indices"], index)
+        for name in SPECTRUM_DATA_ARRAYS:
+            arrays[name].append(data[name])
 
-# Meta WorkChain for combining all inputs from a dynamic namespace into List.
-# Used to combine outputs from several subworkflows into one output.
-# It should be launched via run() instead of submit()
-# NOTE: The code has special handling for Dict nodes,
-# which otherwise fail with not being serializable,
-# so we need the get the value with Dict.get_dict() first.
-# We should check whether this is still needed in aiida-2.0
-# Note we cannot make this more general since List and Dict
-# don't have the .value attribute.
-# https://github.com/aiidateam/aiida-core/issues/5313
-class ConcatInputsToList(WorkChain):
-    @classmethod
-    def define(cls, spec):
-        super().define(spec)
-        spec.input_namespace("ns", dynamic=True)
-        spec.output("output", valid_type=List)
-        spec.outline(cls.combine)
-
-    def combine(self):
-        input_list = [
-            self.inputs.ns[k].get_dict()
-            if isinstance(self.inputs.ns[k], Dict)
-            else self.inputs.ns[k]
-            for k in self.inputs.ns
+    spectrum_data = ArrayData()
+    for name, values in arrays.items():
+        dtype = float if name in ("energies", "osc_strengths") else np.int32
+        spectrum_data.set_array(name, np.concatenate(values).astype(dtype))
+    return spectrum_data
+
+
+@calcfunction
+def concat_structures_to_trajectory(**kwargs):
+    """Combine StructureData into TrajectoryData
+
+    Structures are passed as structure_<index>. If ORCA output parameters
+    are passed for each structure as output_parameters_<index>,
+    final SCF energies (in eV) are stored in the 'energies' array
+    of the TrajectoryData."""
+    # TODO: Maybe allow other types other than StructureData?
+    # Not sure what are the requirements for TrajectoryData
+    indices = sorted(
+        int(key.rpartition("_")[2]) for key in kwargs if key.startswith("structure_")
+    )
+    structurelist = [kwargs[f"structure_{i}"] for i in indices]
+    trajectory = TrajectoryData(structurelist=structurelist)
+    if any(key.startswith("output_parameters_") for key in kwargs):
+        energies = [
+            kwargs[f"output_parameters_{i}"]["scfenergies"][-1] for i in indices
         ]
-        self.out("output", List(list=input_list).store())
+        trajectory.set_array("energies", np.array(energies))
+    return trajectory
 
 
-# TODO: Allow optional inputs for array data to store energies
-class ConcatStructuresToTrajectory(WorkChain):
-    """WorkChain for combining a list of StructureData into TrajectoryData"""
+@calcfunction
+def count_wigner_geometries(spectrum_data):
+    """Number of distinct Wigner geometries in spectrum data"""
+    return Int(len(np.unique(spectrum_data.get_array("geom_indices"))))
 
-    @classmethod
-    def define(cls, spec):
-        super().define(spec)
-        # TODO: Maybe allow other types other than StructureData?
-        # Not sure what are the requirements for TrajectoryData
-        spec.input_namespace("structures", dynamic=True, valid_type=StructureData)
-        spec.output("trajectory", valid_type=TrajectoryData)
-        spec.outline(cls.combine)
 
-    def combine(self):
-        structurelist = [self.inputs.structures[k] for k in self.inputs.structures]
-        self.out("trajectory", TrajectoryData(structurelist=structurelist).store())
+def _validate_positive(value, _):
+    if value is not None and value.value < 1:
+        return "must be a positive integer"
+
+
+def _validate_sampling_method(value, _):
+    if value is not None and value.value not in SAMPLING_METHODS:
+        return f"must be one of {SAMPLING_METHODS}"
+
+
+def _get_running(processes):
+    """Returns processes that have not terminated yet"""
+    return [process for process in processes if not process.is_terminated]
+
+
+def _get_free_slots(nrunning, max_concurrent):
+    """Number of processes that can be submitted
+    so that at most max_concurrent processes run at the same time.
+    max_concurrent=None means no limit."""
+    if max_concurrent is None:
+        return sys.maxsize
+    return max(max_concurrent.value - nrunning, 0)
+
+
+def _broaden_spectrum(output_parameters, x, width):
+    """Gaussian broadened spectrum on energy grid x (in eV),
+    averaged over all geometries, i.e. ORCA output parameters"""
+    energies = np.concatenate([p["etenergies"] for p in output_parameters])
+    osc_strengths = np.concatenate([p["etoscs"] for p in output_parameters])
+    energies = energies / EV_TO_CM
+    kernel = np.exp(-0.5 * np.square((x[:, np.newaxis] - energies) / width))
+    return kernel @ osc_strengths / len(output_parameters)
+
+
+def get_spectrum_change(old_parameters, new_parameters, width=CONVERGENCE_BROADENING):
+    """Relative L2 norm of the change of broadened spectrum
+    when ORCA outputs new_parameters are added to old_parameters"""
+    all_parameters = list(old_parameters) + list(new_parameters)
+    energies = np.concatenate([p["etenergies"] for p in all_parameters]) / EV_TO_CM
+    if len(energies) == 0:
+        return 0.0
+    x = np.arange(energies.min() - 5 * width, energies.max() + 5 * width, width / 5)
+    y_old = _broaden_spectrum(old_parameters, x, width)
+    y_new = _broaden_spectrum(all_parameters, x, width)
+    norm = np.linalg.norm(y_new)
+    if norm == 0.0:
+        return 0.0
+    return np.linalg.norm(y_new - y_old) / norm
 
 
 @calcfunction
-def pick_wigner_structure(wigner_structures, index):
-    return wigner_structures.get_step_structure(index.value)
+def pick_wigner_structures(wigner_structures):
+    """Split TrajectoryData into StructureData for each step,
+    returned as outputs structure_<stepid>.
+    A single calcfunction for all structures is much cheaper than
+    a separate process for each of them."""
+    return {
+        f"structure_{i}": wigner_structures.get_step_structure(i)
+        for i in wigner_structures.get_stepids()
+    }
 
 
 @calcfunction
-def generate_wigner_structures(orca_output_dict, nsample):
+def generate_wigner_structures(orca_output_dict, nsample, sampling_method=None):
+    """Sample nsample geometries from the Wigner distribution.
+    sampling_method is one of wigner.SAMPLING_METHODS, by default "random"."""
     seed = orca_output_dict.extras["_aiida_hash"]
+    sampling = sampling_method.value if sampling_method is not None else "random"
 
     frequencies = orca_output_dict["vibfreqs"]
     masses = orca_output_dict["atommasses"]
     normal_modes = orca_output_dict["vibdisps"]
     elements = orca_output_dict["elements"]
-    min_coord = orca_output_dict["atomcoords"][-1]
-    natom = orca_output_dict["natom"]
-    # convert to Bohrs
-    ANG2BOHRS = 1.0 / 0.529177211
-    coordinates = []
-    # TODO: Do the conversion in wigner.py
+    # Minimum geometry in bohrs
+    min_coord = np.asarray(orca_output_dict["atomcoords"][-1]) * ANG_TO_BOHR
     # TODO: Use ASE object in wigner.py
-    for iat in range(natom):
-        coordinates.append(
-            [
-                min_coord[iat][0] * ANG2BOHRS,
-                min_coord[iat][1] * ANG2BOHRS,
-                min_coord[iat][2] * ANG2BOHRS,
-            ]
-        )
-
-    w = Wigner(elements, masses, coordinates, frequencies, normal_modes, seed)
-
-    wigner_list = []
-    for i in range(nsample.value):
-        wigner_coord = w.get_sample()
-        # Convert to angstroms
-        wigner_coord_ang = []
-        for iat in range(natom):
-            wigner_coord_ang.append(
-                [
-                    wigner_coord[iat][0] / ANG2BOHRS,
-                    wigner_coord[iat][1] / ANG2BOHRS,
-                    wigner_coord[iat][2] / ANG2BOHRS,
-                ]
-            )
-        # TODO: We shouldn't need to specify cell
-        # https://github.com/aiidateam/aiida-core/issues/5248
-        ase_struct = ase.Atoms(
-            positions=wigner_coord_ang,
-            symbols=elements,
-            cell=(1.0, 1.0, 1.0),
-            pbc=False,
-        )
-        wigner_list.append(StructureData(ase=ase_struct))
-
-    return TrajectoryData(structurelist=wigner_list)
+    w = Wigner(elements, masses, min_coord, frequencies, normal_modes, seed, sampling)
+
+    # Convert to angstroms
+    wigner_coords = w.get_samples(nsample.value) / ANG_TO_BOHR
+    trajectory = TrajectoryData()
+    # TODO: We shouldn't need to specify cell
+    # https://github.com/aiidateam/aiida-core/issues/5248
+    cells = np.broadcast_to(np.eye(3), (len(wigner_coords), 3, 3))
+    trajectory.set_trajectory(
+        symbols=elements,
+        positions=wigner_coords,
+        cells=np.ascontiguousarray(cells),
+    )
+    return trajectory
 
 
 class OrcaWignerSpectrumWorkChain(WorkChain):
@@ -154,6 +235,56 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
             "nwigner", valid_type=Int, default=lambda: Int(1), serializer=to_aiida_type
         )
 
+        # Adaptive Wigner sampling, geometries are computed in batches
+        # until the spectrum converges, or until nwigner geometries are computed.
+        spec.input(
+            "wigner_convergence_threshold",
+            valid_type=Float,
+            required=False,
+            serializer=to_aiida_type,
+            help="Stop Wigner sampling when relative change of the spectrum "
+            "after a batch of geometries falls below this threshold",
+        )
+        spec.input(
+            "wigner_batch_size",
+            valid_type=Int,
+            validator=_validate_positive,
+            default=lambda: Int(10),
+            serializer=to_aiida_type,
+            help="Number of Wigner geometries computed in one batch "
+            "in adaptive sampling",
+        )
+        spec.input(
+            "wigner_geometries_per_job",
+            valid_type=Int,
+            validator=_validate_positive,
+            default=lambda: Int(1),
+            serializer=to_aiida_type,
+            help="Number of Wigner geometries computed sequentially "
+            "in a single ORCA job, see OrcaBatchCalculation. "
+            "The max_wallclock_seconds option of the excited state calculation "
+            "applies to a single geometry and is multiplied by the batch size",
+        )
+        spec.input(
+            "wigner_sampling_method",
+            valid_type=Str,
+            default=lambda: Str("random"),
+            validator=_validate_sampling_method,
+            serializer=to_aiida_type,
+            help="Pseudo-random, or quasi-random (sobol, halton) sampling "
+            "of Wigner geometries. Quasi-random sampling covers the distribution "
+            "more evenly, so spectrum converges with fewer geometries.",
+        )
+        spec.input(
+            "max_concurrent_calcs",
+            valid_type=Int,
+            validator=_validate_positive,
+            required=False,
+            serializer=to_aiida_type,
+            help="Maximum number of Wigner calculations running at the same time. "
+            "New calculations are submitted as the older ones finish.",
+        )
+
         spec.output("relaxed_structure", valid_type=StructureData, required=False)
         spec.output(
             "single_point_tddft",
@@ -165,9 +296,16 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
         # TODO: Rename this port
         spec.output(
             "wigner_tddft",
-            valid_type=List,
+            valid_type=ArrayData,
+            required=False,
+            help="Excitation energies and oscillator strengths "
+            "from all Wigner TDDFT calculations",
+        )
+        spec.output(
+            "nwigner",
+            valid_type=Int,
             required=False,
-            help="Output parameters from all Wigner TDDFT calculation",
+            help="Number of Wigner geometries actually computed",
         )
 
         spec.outline(
@@ -176,13 +314,21 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
                 cls.optimize,
                 cls.inspect_optimization,
             ),
+            # Single point TDDFT runs concurrently with Wigner calculations,
+            # it is awaited only after all of them finish.
             cls.excite,
-            cls.inspect_excitation,
             if_(cls.should_run_wigner)(
                 cls.wigner_sampling,
-                cls.wigner_excite,
-                cls.inspect_wigner_excitation,
+                while_(cls.should_continue_wigner)(
+                    cls.start_wigner_round,
+                    while_(cls.should_submit_wigner)(
+                        cls.wigner_excite,
+                    ),
+                    cls.inspect_wigner_excitation,
+                ),
             ),
+            cls.wait_excitation,
+            cls.inspect_excitation,
             cls.results,
         )
 
@@ -199,9 +345,11 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
         """Setup workchain"""
         # TODO: This should be base on some input parameter
         self.ctx.nstates = 3
+        self.ctx.wigner_failed = False
 
     def excite(self):
-        """Calculate excited states for a single geometry"""
+        """Calculate excited states for a single geometry.
+        The calculation is not awaited here, see wait_excitation()"""
         inputs = self.exposed_inputs(
             OrcaBaseWorkChain, namespace="exc", agglomerate=False
         )
@@ -220,26 +368,139 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
 
         calc_exc = self.submit(OrcaBaseWorkChain, **inputs)
         calc_exc.label = "single-point-tddft"
-        return ToContext(calc_exc=calc_exc)
+        self.ctx.calc_exc = calc_exc
+
+    def wait_excitation(self):
+        """Wait for the single point calculation submitted in excite().
+        It has likely already finished together with Wigner calculations."""
+        return ToContext(calc_exc=self.ctx.calc_exc)
 
     def wigner_sampling(self):
         self.report(f"Generating {self.inputs.nwigner.value} Wigner geometries")
-        self.ctx.wigner_structures = generate_wigner_structures(
-            self.ctx.calc_opt.outputs.output_parameters, self.inputs.nwigner
+        wigner_trajectory = generate_wigner_structures(
+            self.ctx.calc_opt.outputs.output_parameters,
+            self.inputs.nwigner,
+            self.inputs.wigner_sampling_method,
         )
+        structures = pick_wigner_structures(wigner_trajectory)
+        self.ctx.wigner_structures = [
+            structures[f"structure_{i}"] for i in wigner_trajectory.get_stepids()
+        ]
+        self.ctx.wigner_calcs = []
+        self.ctx.nwigner_submitted = 0
+        # Wigner geometries are computed in rounds, see is_adaptive_wigner()
+        self.ctx.wigner_round_end = 0
+        # Number of Wigner geometries already checked for convergence
+        self.ctx.nwigner_checked = 0
+        self.ctx.wigner_converged = False
+
+    def is_adaptive_wigner(self):
+        return "wigner_convergence_threshold" in self.inputs
+
+    def start_wigner_round(self):
+        start = self.ctx.nwigner_submitted
+        end = len(self.ctx.wigner_structures)
+        if self.is_adaptive_wigner():
+            end = min(start + self.inputs.wigner_batch_size.value, end)
+            self.report(f"Computing Wigner geometries {start + 1}-{end}")
+        self.ctx.wigner_round_start = start
+        self.ctx.wigner_round_end = end
+
+    def should_submit_wigner(self):
+        return self.ctx.nwigner_submitted < self.ctx.wigner_round_end
 
     def wigner_excite(self):
+        """Submit Wigner calculations of the current round.
+        If the number of concurrent calculations is limited,
+        submit as many as possible and wait for the oldest running one.
+        This step is repeated until all calculations are submitted."""
+        running = _get_running(self.ctx.wigner_calcs)
+        nslots = _get_free_slots(len(running), self.inputs.get("max_concurrent_calcs"))
+        per_job = self.inputs.wigner_geometries_per_job.value
+        start = self.ctx.nwigner_submitted
+        end = min(self.ctx.wigner_round_end, start + nslots * per_job)
+
+        calcs = self._submit_wigner_calcs(self.ctx.wigner_structures[start:end], start)
+        self.ctx.wigner_calcs.extend(calcs)
+        self.ctx.nwigner_submitted = end
+        running.extend(calcs)
+
+        nfinished = len(self.ctx.wigner_calcs) - len(running)
+        nwaiting = self.ctx.wigner_round_end - end
+        if nwaiting > 0:
+            self.report(
+                f"Wigner calculations: {nfinished} finished, {len(running)} running, "
+                f"{nwaiting} geometries waiting for submission"
+            )
+            return ToContext(wigner_oldest=running[0])
+        for calc in running:
+            self.to_context(wigner_pending=append_(calc))
+
+    def _submit_wigner_calcs(self, structures, start):
+        """Submit TDDFT calculations for Wigner structures,
+        either separately or in batches, see OrcaBatchCalculation.
+        start is the index of the first structure among all Wigner geometries,
+        batched structures are labeled by these global indices.
+        Returns the list of submitted processes."""
         inputs = self.exposed_inputs(
             OrcaBaseWorkChain, namespace="exc", agglomerate=False
         )
         inputs.orca.code = self.inputs.code
-        for i in self.ctx.wigner_structures.get_stepids():
-            inputs.orca.structure = pick_wigner_structure(
-                self.ctx.wigner_structures, Int(i)
+        per_job = self.inputs.wigner_geometries_per_job.value
+        calcs = []
+        if per_job == 1:
+            for structure in structures:
+                inputs.orca.structure = structure
+                calc = self.submit(OrcaBaseWorkChain, **inputs)
+                calc.label = "wigner-single-point-tddft"
+                calcs.append(calc)
+            return calcs
+
+        # Options specific to OrcaCalculation, in particular its parser,
+        # are filled in by defaults of the exposed inputs.
+        options = {
+            key: value
+            for key, value in inputs.orca.metadata.get("options", {}).items()
+            if key not in ("parser_name", "input_filename", "output_filename")
+        }
+        # Wallclock limit is given for a single geometry, geometries in a batch
+        # are computed sequentially.
+        wallclock = options.pop("max_wallclock_seconds", None)
+        # NOTE: Unlike OrcaBaseWorkChain, failed jobs are not restarted,
+        # but successful geometries from failed batches are still used,
+        # see inspect_wigner_excitation()
+        for i in range(0, len(structures), per_job):
+            batch = structures[i : i + per_job]
+            batch_options = dict(options)
+            if wallclock is not None:
+                batch_options["max_wallclock_seconds"] = wallclock * len(batch)
+            calc = self.submit(
+                OrcaBatchCalculation,
+                code=inputs.orca.code,
+                parameters=inputs.orca.parameters,
+                structures={
+                    f"structure_{start + i + j}": s for j, s in enumerate(batch)
+                },
+                metadata={"options": batch_options},
             )
-            calc = self.submit(OrcaBaseWorkChain, **inputs)
-            calc.label = "wigner-single-point-tddft"
-            self.to_context(wigner_calcs=append_(calc))
+            calc.label = "wigner-batch-tddft"
+            calcs.append(calc)
+        return calcs
+
+    def _get_wigner_output_parameters(self):
+        """ORCA output parameters of successful Wigner calculations,
+        as a dictionary keyed by Wigner geometry indices, in their order.
+        Batched calculations might have failed only for some geometries."""
+        output_parameters = {}
+        for index, calc in enumerate(self.ctx.wigner_calcs):
+            if calc.process_class is OrcaBatchCalculation:
+                for i in OrcaBatchCalculation.get_indices(calc.inputs.structures):
+                    if f"output_parameters_{i}" in calc.outputs:
+                        output_parameters[i] = calc.outputs[f"output_parameters_{i}"]
+            elif calc.is_finished_ok:
+                # Without batching, each geometry is a separate calculation
+                output_parameters[index] = calc.outputs.output_parameters
+        return output_parameters
 
     def optimize(self):
         """Optimize geometry"""
@@ -260,17 +521,67 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
 
     def inspect_excitation(self):
         """Check whether excitation succeeded"""
+        if self.ctx.wigner_failed:
+            return self.exit_codes.ERROR_EXCITATION_FAILED
         if not self.ctx.calc_exc.is_finished_ok:
             self.report("Single point excitation failed :-(")
             return self.exit_codes.ERROR_EXCITATION_FAILED
 
+    def _abort_wigner(self):
+        """Stop Wigner sampling after a failure.
+
+        We cannot fail right away, since the single point calculation
+        submitted in excite() might still be running, so we wait for it
+        and fail in inspect_excitation()."""
+        self.ctx.wigner_failed = True
+        return ToContext(calc_exc=self.ctx.calc_exc)
+
     def inspect_wigner_excitation(self):
-        """Check whether all wigner excitations succeeded"""
+        """Check whether Wigner excitations of the current round succeeded.
+
+        Failed batched calculations are not restarted, so instead of
+        failing the workflow, geometries that failed are skipped,
+        as long as at least some Wigner geometries succeeded."""
         for calc in self.ctx.wigner_calcs:
-            if not calc.is_finished_ok:
+            if (
+                not calc.is_finished_ok
+                and calc.process_class is not OrcaBatchCalculation
+            ):
                 # TODO: Report all failed calcs at once
                 self.report("Wigner excitation failed :-(")
-                return self.exit_codes.ERROR_EXCITATION_FAILED
+                return self._abort_wigner()
+
+        output_parameters = self._get_wigner_output_parameters()
+        failed = [
+            i
+            for i in range(self.ctx.wigner_round_start, self.ctx.wigner_round_end)
+            if i not in output_parameters
+        ]
+        if failed:
+            self.report(
+                f"Skipping {len(failed)} failed Wigner geometries: "
+                + ", ".join(str(i + 1) for i in failed)
+            )
+        if not output_parameters:
+            self.report("All Wigner excitations failed :-(")
+            return self._abort_wigner()
+
+        if not self.is_adaptive_wigner():
+            return
+        output_parameters = list(output_parameters.values())
+        nold = self.ctx.nwigner_checked
+        self.ctx.nwigner_checked = len(output_parameters)
+        # We need at least two batches to estimate convergence
+        if nold == 0:
+            return
+        change = get_spectrum_change(output_parameters[:nold], output_parameters[nold:])
+        threshold = self.inputs.wigner_convergence_threshold.value
+        self.report(
+            f"Relative spectrum change with {len(output_parameters)} geometries: {change:.3g}"
+        )
+        if change < threshold:
+            self.report(f"Spectrum converged below threshold {threshold}")
+            self.ctx.wigner_converged = True
 
     def should_optimize(self):
         if self.inputs.optimize:
@@ -280,6 +591,11 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
     def should_run_wigner(self):
         return self.should_optimize() and self.inputs.nwigner > 0
 
+    def should_continue_wigner(self):
+        if self.ctx.wigner_failed or self.ctx.wigner_converged:
+            return False
+        return self.ctx.nwigner_submitted < self.inputs.nwigner.value
+
     def results(self):
         """Expose results from child workchains"""
 
@@ -288,15 +604,14 @@ class OrcaWignerSpectrumWorkChain(WorkChain):
 
         if self.should_run_wigner():
             self.report("Concatenating Wigner outputs")
-            # TODO: Instead of deepcopying all dicts,
-            # only pick the data that we need for the spectrum to save space.
-            # We should introduce a special aiida type for spectrum data
+            output_parameters = self._get_wigner_output_parameters()
             data = {
-                str(i): wc.outputs.output_parameters
-                for i, wc in enumerate(self.ctx.wigner_calcs)
+                f"output_parameters_{i}": params
+                for i, params in output_parameters.items()
             }
-            all_results = run(ConcatInputsToList, ns=data)
-            self.out("wigner_tddft", all_results["output"])
+            spectrum_data = concat_spectrum_data(**data)
+            self.out("wigner_tddft", spectrum_data)
+            self.out("nwigner", count_wigner_geometries(spectrum_data))
 
         self.out("single_point_tddft", self.ctx.calc_exc.outputs.output_parameters)
 
@@ -309,10 +624,19 @@ class AtmospecWorkChain(WorkChain):
         super().define(spec)
         spec.expose_inputs(OrcaWignerSpectrumWorkChain, exclude=["structure"])
         spec.input("structure", valid_type=(StructureData, TrajectoryData))
+        spec.input(
+            "max_concurrent_conformers",
+            valid_type=Int,
+            validator=_validate_positive,
+            required=False,
+            serializer=to_aiida_type,
+            help="Maximum number of conformers computed at the same time. "
+            "New conformers are submitted as the older ones finish.",
+        )
 
         spec.output(
             "spectrum_data",
-            valid_type=List,
+            valid_type=ArrayData,
             required=True,
             help="All data necessary to construct spectrum in SpectrumWidget",
         )
@@ -325,40 +649,71 @@ class AtmospecWorkChain(WorkChain):
         )
 
         spec.outline(
-            cls.launch,
+            cls.setup,
+            while_(cls.should_launch)(
+                cls.launch,
+            ),
             cls.collect,
         )
 
         # Very generic error now
         spec.exit_code(410, "CONFORMER_ERROR", "Conformer spectrum generation failed")
 
-    def launch(self):
-        inputs = self.exposed_inputs(OrcaWignerSpectrumWorkChain, agglomerate=False)
-        # Single conformer
-        # TODO: Test this!
+    def setup(self):
         if isinstance(self.inputs.structure, StructureData):
-            self.report("Launching ATMOSPEC for 1 conformer")
-            inputs.structure = self.inputs.structure
-            return ToContext(conf=self.submit(OrcaWignerSpectrumWorkChain, **inputs))
+            self.ctx.nconformers = 1
+        else:
+            self.ctx.nconformers = len(self.inputs.structure.get_stepids())
+        self.report(f"Launching ATMOSPEC for {self.ctx.nconformers} conformers")
+        # Conformer workflows in the order of submission
+        self.ctx.confs = []
 
-        self.report(
-            f"Launching ATMOSPEC for {len(self.inputs.structure.get_stepids())} conformers"
+    def should_launch(self):
+        return len(self.ctx.confs) < self.ctx.nconformers
+
+    def _get_conformer_structure(self, index):
+        if isinstance(self.inputs.structure, StructureData):
+            return self.inputs.structure
+        conf_id = self.inputs.structure.get_stepids()[index]
+        return self.inputs.structure.get_step_structure(conf_id)
+
+    def launch(self):
+        """Submit conformer workflows. If the number of concurrent conformers
+        is limited, submit as many as possible and wait for the oldest running one.
+        This step is repeated until all conformers are submitted."""
+        inputs = self.exposed_inputs(OrcaWignerSpectrumWorkChain, agglomerate=False)
+        running = _get_running(self.ctx.confs)
+        nslots = _get_free_slots(
+            len(running), self.inputs.get("max_concurrent_conformers")
         )
-        for conf_id in self.inputs.structure.get_stepids():
-            inputs.structure = self.inputs.structure.get_step_structure(conf_id)
+        start = len(self.ctx.confs)
+        end = min(self.ctx.nconformers, start + nslots)
+        for i in range(start, end):
+            inputs.structure = self._get_conformer_structure(i)
             workflow = self.submit(OrcaWignerSpectrumWorkChain, **inputs)
             # workflow.label = 'conformer-wigner-spectrum'
-            self.to_context(confs=append_(workflow))
+            self.ctx.confs.append(workflow)
+            running.append(workflow)
+
+        nwaiting = self.ctx.nconformers - end
+        if nwaiting > 0:
+            nfinished = len(self.ctx.confs) - len(running)
+            self.report(
+                f"Conformers: {nfinished} finished, {len(running)} running, "
+                f"{nwaiting} waiting for submission"
+            )
+            return ToContext(conf_oldest=running[0])
+        for workflow in running:
+            self.to_context(conf_pending=append_(workflow))
 
     def collect(self):
         # For single conformer
         # TODO: This currently does not work
         if isinstance(self.inputs.structure, StructureData):
-            if not self.ctx.conf.is_finished_ok:
+            conf = self.ctx.confs[0]
+            if not conf.is_finished_ok:
                 return self.exit_codes.CONFORMER_ERROR
-            self.out_many(
-                self.exposed_outputs(self.ctx.conf, OrcaWignerSpectrumWorkChain)
-            )
+            self.out_many(self.exposed_outputs(conf, OrcaWignerSpectrumWorkChain))
             return
 
         # Check for errors
@@ -369,19 +724,22 @@ class AtmospecWorkChain(WorkChain):
                 return self.exit_codes.CONFORMER_ERROR
 
         # Combine all spectra data
-        data = {str(i): wc.outputs.wigner_tddft for i, wc in enumerate(self.ctx.confs)}
-        all_results = run(ConcatInputsToList, ns=data)
-        self.out("spectrum_data", all_results["output"])
-
-        # Combine all optimized geometries into single TrajectoryData
-        # TODO: Include energies in TrajectoryData for optimized structures
+        data = {
+            f"spectrum_data_{i}": wc.outputs.wigner_tddft
+            for i, wc in enumerate(self.ctx.confs)
+        }
+        self.out("spectrum_data", concat_spectrum_data(**data))
+
+        # Combine all optimized geometries into single TrajectoryData,
+        # together with their ground state energies for Boltzmann weighting.
+        # SCF energy from the single point TDDFT calculation is the energy
+        # at the optimized geometry.
         if self.inputs.optimize:
-            relaxed_structures = {
-                str(i): wc.outputs.relaxed_structure
-                for i, wc in enumerate(self.ctx.confs)
-            }
-            output = run(ConcatStructuresToTrajectory, structures=relaxed_structures)
-            self.out("relaxed_structures", output["trajectory"])
+            data = {}
+            for i, wc in enumerate(self.ctx.confs):
+                data[f"structure_{i}"] = wc.outputs.relaxed_structure
+                data[f"output_parameters_{i}"] = wc.outputs.single_point_tddft
+            self.out("relaxed_structures", concat_structures_to_trajectory(**data))
 
 
 __version__ = "0.1-alpha"
@@ -0,0 +1,180 @@
+"""ORCA calculation of several molecular geometries in a single CalcJob
+
+For small molecules, the overhead of a separate scheduler job,
+file staging and ORCA startup for each Wigner geometry can dominate
+the actual TDDFT computation. OrcaBatchCalculation runs ORCA
+for each geometry sequentially within one job, and the OrcaBatchParser
+returns ORCA output parameters for each geometry separately,
+in the same format as the OrcaCalculation from aiida-orca.
+"""
+
+import numpy as np
+from aiida.common import CalcInfo, CodeInfo, CodeRunMode
+from aiida.engine import CalcJob, ExitCode
+from aiida.orm import Dict, StructureData, to_aiida_type
+from aiida.parsers import Parser
+
+
+class OrcaBatchCalculation(CalcJob):
+    """Run the same ORCA calculation for several structures, one after another.
+
+    Structures are passed in the 'structures' namespace as structure_<index>,
+    ORCA output parameters for each of them are returned as outputs
+    output_parameters_<index>. Input parameters have the same format
+    as for the OrcaCalculation."""
+
+    _INPUT_FILE = "aiida_{}.inp"
+    _OUTPUT_FILE = "aiida_{}.out"
+    _INPUT_COORDS_FILE = "aiida_{}.coords.xyz"
+    _PARSER = "atmospec.orca_batch"
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input_namespace(
+            "structures",
+            valid_type=StructureData,
+            dynamic=True,
+            help="Input structures, labeled as structure_<index>",
+        )
+        spec.input(
+            "parameters",
+            valid_type=Dict,
+            serializer=to_aiida_type,
+            help="Input parameters to generate the input files",
+        )
+        spec.input(
+            "metadata.options.parser_name",
+            valid_type=str,
+            default=cls._PARSER,
+            non_db=True,
+        )
+        spec.input("metadata.options.withmpi", valid_type=bool, default=False)
+
+        spec.outputs.dynamic = True
+        spec.outputs.valid_type = Dict
+
+        spec.exit_code(
+            302,
+            "ERROR_OUTPUT_STDOUT_MISSING",
+            message="The retrieved folder did not contain some of the output files.",
+        )
+        spec.exit_code(
+            303,
+            "ERROR_CALCULATION_UNSUCCESSFUL",
+            message="Some of the ORCA calculations did not finish successfully.",
+        )
+        spec.exit_code(
+            311,
+            "ERROR_OUTPUT_STDOUT_PARSE",
+            message="Some of the output files could not be parsed.",
+        )
+
+    @classmethod
+    def get_indices(cls, labels):
+        """Sorted indices of structures from their input labels"""
+        return sorted(int(label.rpartition("_")[2]) for label in labels)
+
+    def prepare_for_submission(self, folder):
+        params = self.inputs.parameters.get_dict()
+        for key in ("charge", "multiplicity"):
+            if params.get(key) is None:
+                raise ValueError(f'Missing mandatory key "{key}" in input parameters')
+
+        indices = self.get_indices(self.inputs.structures)
+        codes_info = []
+        for i in indices:
+            coords_file = self._INPUT_COORDS_FILE.format(i)
+            input_file = self._INPUT_FILE.format(i)
+            ase_struct = self.inputs.structures[f"structure_{i}"].get_ase()
+            # ORCA cannot read the extended XYZ format
+            ase_struct.write(
+                folder.get_abs_path(coords_file), format="extxyz", plain=True
+            )
+            with folder.open(input_file, "w") as f:
+                f.write(self._render_input(params, coords_file))
+
+            codeinfo = CodeInfo()
+            codeinfo.cmdline_params = [input_file]
+            codeinfo.stdout_name = self._OUTPUT_FILE.format(i)
+            codeinfo.join_files = True
+            codeinfo.code_uuid = self.inputs.code.uuid
+            codes_info.append(codeinfo)
+
+        calcinfo = CalcInfo()
+        calcinfo.codes_info = codes_info
+        calcinfo.codes_run_mode = CodeRunMode.SERIAL
+        calcinfo.retrieve_list = [self._OUTPUT_FILE.format(i) for i in indices]
+        return calcinfo
+
+    @staticmethod
+    def _render_input(params, coords_file):
+        """ORCA input file in the same format as generated by aiida-orca"""
+        lines = [f"! {' '.join(params.get('input_keywords', ['SP']))}"]
+        if params.get("extra_input_keywords"):
+            lines.append(f"! {' '.join(params['extra_input_keywords'])}")
+        for block, keywords in params.get("input_blocks", {}).items():
+            lines.append(f"%{block}")
+            for keyword, value in keywords.items():
+                lines.append(
+                    f"\t{keyword}" if value is None else f"\t{keyword} {value}"
+                )
+            lines.append("end")
+        charge, mult = params["charge"], params["multiplicity"]
+        lines.append(f"* xyzfile {charge} {mult} {coords_file}")
+        return "\n".join(lines) + "\n"
+
+
+class OrcaBatchParser(Parser):
+    """Parse ORCA outputs of OrcaBatchCalculation with cclib.
+    Outputs of successful calculations are returned
+    even if some other calculations in the batch failed."""
+
+    def parse(self, **kwargs):
+        try:
+            # Newer versions of aiida-orca ship their own copy of cclib,
+            # use the same one as the OrcaCalculation parser
+            from aiida_orca.parsers.cclib.ccio import ccread
+        except ImportError:
+            from cclib.io import ccread
+
+        process_cls = self.node.process_class
+        labels = self.node.inputs.structures
+        retrieved = self.retrieved.list_object_names()
+
+        exit_code = ExitCode(0)
+        for i in process_cls.get_indices(labels):
+            fname = process_cls._OUTPUT_FILE.format(i)
+            if fname not in retrieved:
+                exit_code = self.exit_codes.ERROR_OUTPUT_STDOUT_MISSING
+                continue
+            try:
+                with self.retrieved.open(fname) as handle:
+                    output_dict = ccread(handle).getattributes()
+            except Exception as e:
+                self.logger.error(f"cclib could not parse file {fname}: {e}")
+                exit_code = self.exit_codes.ERROR_OUTPUT_STDOUT_PARSE
+                continue
+
+            # NaN values cannot be stored in the database, see aiida-orca
+            for key, value in output_dict.items():
+                if isinstance(value, np.ndarray):
+                    output_dict[key] = np.nan_to_num(
+                        value, nan=123456789, posinf=2e308, neginf=-2e308
+                    )
+            # Newer cclib versions store timings as timedelta,
+            # which cannot be stored in the database either
+            metadata = output_dict.get("metadata", {})
+            for key in ("cpu_time", "wall_time"):
+                if key in metadata:
+                    metadata[key] = [t.total_seconds() for t in metadata[key]]
+            # ORCA does not print CI coefficients for full TDDFT
+            if "etsecs" in output_dict and np.isnan(output_dict["etsecs"][0][0][-1]):
+                del output_dict["etsecs"]
+
+            if not output_dict.get("metadata", {}).get("success"):
+                exit_code = self.exit_codes.ERROR_CALCULATION_UNSUCCESSFUL
+                continue
+            self.out(f"output_parameters_{i}", Dict(dict=output_dict))
+
+        return exit_code